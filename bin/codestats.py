@@ -7,22 +7,42 @@
 Print statistics about a code project.
 
 Usage:
-    codestats.py [-d] [-v]
+    codestats.py [-d] [-v] [-j <N>]
+    codestats.py --history [--daily] [--json] [-d] [-j <N>]
 
 Options:
     -d --debug         # print debug output
     -v --verbose       # print more details
+    -j <N> --jobs=<N>  # number of worker processes (0 = num CPUs);
+                       # default=0
+    --history          # print the lines per ext after every commit of
+                       # the current branch, as CSV
+    --daily            # with --history, print the last commit of
+                       # every day only
+    --json             # with --history, print one JSON object per
+                       # line instead of CSV
 """
 
 from __future__ import print_function, division
 import collections
+import csv
+import json
 import os
-import string
+import re
+import stat
 import subprocess
 import sys
+import time
 
 from docopt import docopt  # requires 'pip install docopt'
 
+from sysconf import get_state_path
+from sysconf import iter_blocks
+from sysconf import load_state
+from sysconf import parallel_map
+from sysconf import save_state
+from sysconf import walk_files
+
 
 # https://github.com/sindresorhus/text-extensions/
 SRC_EXTS = set([
@@ -96,9 +116,97 @@ SHEBANGS = {
     '#!/usr/bin/php': '.php',
     '#!/usr/bin/ruby': '.rb',
 }
+# The comment and string syntax of the exts above (and of the
+# KNOWN_BASENAMES), used to tell code and comment lines apart: 'line'
+# comments run until the end of the line, 'block' comments until
+# their end token. 'strings' end on the same line, 'multiline' ones
+# don't. 'docstrings' are multiline strings which count as comments
+# when they start a line (as Python docstrings).
+C_SYNTAX = dict(line=['//'], block=[('/*', '*/')], strings=['"', "'"])
+HASH_SYNTAX = dict(line=['#'], strings=['"', "'"])
+XML_SYNTAX = dict(block=[('<!--', '-->')])
+SYNTAX_EXTS = {
+    '.c': C_SYNTAX,
+    '.cc': C_SYNTAX,
+    '.cpp': C_SYNTAX,
+    '.cxx': C_SYNTAX,
+    '.go': dict(C_SYNTAX, multiline=['`']),
+    '.h': C_SYNTAX,
+    '.hpp': C_SYNTAX,
+    '.ino': C_SYNTAX,
+    '.m': C_SYNTAX,
+    '.pch': C_SYNTAX,
+    '.scala': C_SYNTAX,
+    '.js': dict(C_SYNTAX, multiline=['`']),
+    '.jsx': dict(C_SYNTAX, multiline=['`']),
+    '.less': C_SYNTAX,
+    '.sass': C_SYNTAX,
+    '.scss': C_SYNTAX,
+    '.styl': C_SYNTAX,
+    '.stylus': C_SYNTAX,
+    '.css': dict(block=[('/*', '*/')], strings=['"', "'"]),
+    '.php': dict(C_SYNTAX, line=['//', '#']),
+    '.py': dict(HASH_SYNTAX, docstrings=['"""', "'''"]),
+    '.bash': HASH_SYNTAX,
+    '.csh': HASH_SYNTAX,
+    '.sh': HASH_SYNTAX,
+    '.zsh': HASH_SYNTAX,
+    '.bashrc': HASH_SYNTAX,
+    '.zshrc': HASH_SYNTAX,
+    '.pl': HASH_SYNTAX,
+    '.pm': HASH_SYNTAX,
+    '.rb': HASH_SYNTAX,
+    '.coffee': dict(HASH_SYNTAX, block=[('###', '###')]),
+    '.iced': dict(HASH_SYNTAX, block=[('###', '###')]),
+    '.cfg': HASH_SYNTAX,
+    '.cnf': HASH_SYNTAX,
+    '.conf': HASH_SYNTAX,
+    '.properties': dict(line=['#', '!']),
+    '.yaml': HASH_SYNTAX,
+    '.yml': HASH_SYNTAX,
+    '.ini': dict(line=[';', '#'], strings=['"']),
+    '.gitattributes': dict(line=['#']),
+    '.gitignore': dict(line=['#']),
+    '.hgignore': dict(line=['#']),
+    '.npmignore': dict(line=['#']),
+    'Makefile': HASH_SYNTAX,
+    '.sql': dict(line=['--'], block=[('/*', '*/')], strings=["'"]),
+    '.lua': dict(line=['--'], block=[('--[[', ']]')], strings=['"', "'"]),
+    '.erl': dict(line=['%'], strings=['"']),
+    '.vim': dict(line=['"']),
+    '.vimrc': dict(line=['"']),
+    '.gvimrc': dict(line=['"']),
+    '.htm': XML_SYNTAX,
+    '.html': XML_SYNTAX,
+    '.xht': XML_SYNTAX,
+    '.xhtml': XML_SYNTAX,
+    '.xml': XML_SYNTAX,
+    '.xsl': XML_SYNTAX,
+    '.svg': XML_SYNTAX,
+    '.rss': XML_SYNTAX,
+    '.atom': XML_SYNTAX,
+}
+PY3 = sys.version_info[0] == 3
+CHUNK_SIZE = 1024 * 1024
+# How many bytes istext() looks at.
+TEXT_SNIFF_SIZE = 512
+# Fewer files than this are counted serially (see
+# sysconf.parallel_map()).
+PARALLEL_MIN_FILES = 500
+PARALLEL_CHUNKSIZE = 32
+# Bump this when get_file_stats() results change.
+CACHE_VERSION = 2
 DEBUG = False
 VERBOSE = False
 
+# lookup tables
+TEXT_EXTS = set('.' + x for x in SRC_EXTS)
+BINARY_EXTS = set('.' + x for x in BIN_EXTS) - TEXT_EXTS
+TEXT_CHARS = bytes(bytearray(range(32, 127)) + bytearray(b'\n\r\t\b'))
+SHEBANG_EXTS = dict((k.encode('ascii'), v) for k, v in SHEBANGS.items())
+FIRST_LINE_RE = re.compile(b'\\s*([^\\n]*)')
+BLANK_LINE_RE = re.compile(b'^[ \\t\\r\\f\\v]*$', re.MULTILINE)
+
 
 # ===================================================================
 # utils
@@ -106,7 +214,10 @@ VERBOSE = False
 
 
 def sh(cmd):
-    return subprocess.check_output(cmd, shell=True).strip()
+    out = subprocess.check_output(cmd, shell=True).strip()
+    if PY3:
+        out = out.decode()
+    return out
 
 
 def log(msg):
@@ -173,54 +284,210 @@ def hilite(s, color):
 # ===================================================================
 
 
+def stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
 def get_src_files():
+    """Return a list of (file, key) tuples, where 'key' identifies the
+    content of the file: the blob SHA git already computed, or
+    (inode, size, mtime) for files which are not tracked by git or
+    are modified in the working tree.
+    """
+    files = []
     if is_git():
-        out = sh("git ls-files")
-        return [x for x in out.split(b'\n') if os.path.isfile(x)]
+        modified = set(sh("git ls-files -m -z").split('\0'))
+        seen = set()
+        for record in sh("git ls-files -s -z").split('\0'):
+            if not record:
+                continue
+            meta, file = record.split('\t', 1)
+            mode, sha, stage = meta.split()
+            if file in seen or mode == '160000':  # submodule
+                continue
+            seen.add(file)
+            if file in modified or mode == '120000' or stage != '0':
+                # modified, symlink or merge conflict
+                try:
+                    st = os.stat(file)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                files.append((file, stat_key(st)))
+            else:
+                files.append((file, sha))
     else:
-        ls = []
-        for root, subdirs, subfiles in os.walk('.'):
-            root = os.path.normpath(root)
-            if root.split('/')[0] in {'.git', '.svn', '.hg'}:
+        ignore = ['/.git/', '/.svn/', '/.hg/']
+        for entry in walk_files('.', ignore=ignore):
+            try:
+                st = entry.stat()
+            except OSError:
                 continue
-            for file in subfiles:
-                file = os.path.join(root, file)
-                ls.append(file)
-        return ls
+            files.append((os.path.normpath(entry.path), stat_key(st)))
+    return files
 
 
-def get_no_lines(file):
-    with open(file, 'rt') as f:
-        return len(f.readlines())
-
+def make_syntax(line=(), block=(), strings=(), multiline=(),
+                docstrings=()):
+    """Compile a SYNTAX_EXTS entry into a (search, tokens) tuple, where
+    search(line, pos) finds the next token starting a comment or a
+    string and 'tokens' maps it to a (kind, end) tuple. 'end' is the
+    token ending a block comment, or a regex matching the rest of a
+    string (escapes included).
+    """
+    def string_end(token):
+        token = token.encode('ascii')
+        return re.compile(b'(?:\\\\.|[^\\\\])*?' + re.escape(token))
+
+    tokens = {}
+    for token in line:
+        tokens[token] = ('line', None)
+    for token, end in block:
+        tokens[token] = ('block', end.encode('ascii'))
+    for token in strings:
+        tokens[token] = ('string', string_end(token))
+    for token in multiline:
+        tokens[token] = ('multiline', string_end(token))
+    for token in docstrings:
+        tokens[token] = ('docstring', string_end(token))
+    tokens = dict((k.encode('ascii'), v) for k, v in tokens.items())
+    # longest first, so that e.g. '"""' wins over '"'
+    alts = sorted(tokens, key=len, reverse=True)
+    regex = re.compile(b'|'.join(re.escape(x) for x in alts))
+    return regex.search, tokens
+
+
+SYNTAXES = dict((k, make_syntax(**v)) for k, v in SYNTAX_EXTS.items())
+
+
+def classify_lines(lines, syntax, state=None):
+    """Classify a list of lines (without line feeds) as code, comment
+    or blank and return a (code, comment, blank, state) tuple. A line
+    with both code and comments counts as code. 'state' is the
+    (kind, end) of the comment or string still open at the end of the
+    lines, to be passed back with the next ones.
+    """
+    search, tokens = syntax
+    code = comment = blank = 0
+    for line in lines:
+        if not line.strip():
+            blank += 1
+            continue
+        if state is None and search(line) is None:
+            # fast path: no comment nor string in sight
+            code += 1
+            continue
+        has_code = has_comment = False
+        pos = 0
+        while True:
+            if state is not None:
+                kind, end = state
+                if kind == 'block':
+                    has_comment = True
+                    idx = line.find(end, pos)
+                    if idx == -1:
+                        break
+                    pos = idx + len(end)
+                else:
+                    if kind == 'docstring':
+                        has_comment = True
+                    else:
+                        has_code = True
+                    m = end.match(line, pos)
+                    if m is None:
+                        break
+                    pos = m.end()
+                state = None
+            m = search(line, pos)
+            if m is None:
+                if line[pos:].strip():
+                    has_code = True
+                break
+            if line[pos:m.start()].strip():
+                has_code = True
+            kind, end = tokens[m.group()]
+            pos = m.end()
+            if kind == 'line':
+                has_comment = True
+                break
+            elif kind == 'block':
+                state = (kind, end)
+            elif kind == 'docstring' and not has_code:
+                state = (kind, end)
+            else:
+                has_code = True
+                m = end.match(line, pos)
+                if m is not None:
+                    pos = m.end()
+                elif kind == 'string':
+                    break  # unterminated, ends with the line
+                else:
+                    state = ('multiline', end)
+                    break
+        if has_code:
+            code += 1
+        elif has_comment:
+            comment += 1
+        else:
+            code += 1
+    return code, comment, blank, state
+
+
+def count_lines(f, head=b'', syntax=None):
+    """Count the lines of a file object opened in binary mode in a
+    single streaming pass, reading it CHUNK_SIZE bytes at a time so
+    that memory usage doesn't depend on the file size. 'head' is the
+    data already read from it. Return a (lines, code, comment, blank)
+    tuple: without a 'syntax' (see make_syntax()) all the non blank
+    lines count as code. A last line not terminated by a line feed
+    counts as well.
+    """
+    lines = code = comment = blank = 0
+    state = None
+    for block in iter_blocks(f, CHUNK_SIZE, head):
+        if block.endswith(b'\n'):
+            block = block[:-1]
+        n = block.count(b'\n') + 1
+        lines += n
+        if syntax is None or (state is None and syntax[0](block) is None):
+            # no comments: count blank lines at C speed
+            nblank = len(BLANK_LINE_RE.findall(block))
+            blank += nblank
+            code += n - nblank
+        else:
+            c, m, b, state = classify_lines(block.split(b'\n'), syntax,
+                                            state)
+            code += c
+            comment += m
+            blank += b
+    return lines, code, comment, blank
 
-def istext(file):
-    ext = os.path.splitext(file)[1]
-    if ext in SRC_EXTS:
-        return True
-    if ext in BIN_EXTS:
-        return False
 
-    s = open(file).read(512)
-    text_characters = "".join(map(chr, range(32, 127)) + list("\n\r\t\b"))
-    null_trans = string.maketrans("", "")
+def istext(head):
+    """Tell whether the first bytes of a file look like text."""
+    s = head[:TEXT_SNIFF_SIZE]
     if not s:
         # Empty files are considered text
         return True
-    if "\0" in s:
+    if b"\0" in s:
         # Files with null bytes are likely binary
         return False
-    # Get the non-text characters (maps a character to itself then
-    # use the 'remove' option to get rid of the text characters.)
-    t = s.translate(null_trans, text_characters)
+    # Get the non-text characters (use the 'delete' option of
+    # translate() to get rid of the text characters).
+    t = s.translate(None, TEXT_CHARS)
     # If more than 30% non-text characters, then
     # this is considered a binary file
-    if float(len(t)) / float(len(s)) > 0.30:
+    if len(t) / len(s) > 0.30:
         return False
     return True
 
 
-def get_file_ext(file):
+def get_file_ext(file, head):
+    """Return the extension of a file or, if it has none, guess it
+    from its name or from the shebang found in 'head' (the first
+    bytes of the file).
+    """
     ext = os.path.splitext(file)[1]
     if ext:
         return ext
@@ -229,20 +496,229 @@ def get_file_ext(file):
         name = os.path.basename(file)
         if name in KNOWN_BASENAMES:
             return name
-        # guess by shebang
-        with open(file, 'rt') as f:
-            while True:
-                firstline = f.readline()
-                if not firstline:
-                    break
-                firstline = firstline.strip()
-                if firstline:
-                    break
-            try:
-                return SHEBANGS[firstline]
-            except KeyError:
-                warn("can't recognize file %r" % file)
-                return '(no-extension)'
+        # guess by shebang (the first non-empty line)
+        firstline = FIRST_LINE_RE.match(head).group(1).strip()
+        return SHEBANG_EXTS.get(firstline, '(no-extension)')
+
+
+def get_file_stats(file):
+    """Return a (ext, lines, code, comment, blank) tuple for a text
+    file, None for a binary file and False if it can't be read.
+    The file is opened only once: its first block tells whether it's
+    text and its type (from the shebang), then the lines are counted
+    reading on from the same handle.
+    """
+    ext = os.path.splitext(file)[1]
+    if ext in BINARY_EXTS:
+        return None
+    try:
+        with open(file, 'rb') as f:
+            head = f.read(CHUNK_SIZE)
+            if ext not in TEXT_EXTS and not istext(head):
+                return None
+            ext = get_file_ext(file, head)
+            return (ext, ) + count_lines(f, head, SYNTAXES.get(ext))
+    except EnvironmentError as err:
+        warn("can't read %r: %s" % (file, err))
+        return False
+
+
+def collect_stats(files, jobs=0):
+    """Return the get_file_stats() of the (file, key) tuples returned
+    by get_src_files() as a list of (file, result) tuples. Only the
+    files whose content (or type, as told by the name) is not in the
+    cache are read.
+    """
+    cache_path = get_state_path('codestats', ext='.cache')
+    cache = load_state(cache_path, CACHE_VERSION) or {}
+    new_cache = {}
+    results = []
+    todo = {}
+    for file, key in files:
+        key = (key, os.path.splitext(file)[1] or os.path.basename(file))
+        if key in cache:
+            new_cache[key] = cache[key]
+            results.append((file, cache[key]))
+        else:
+            todo[file] = key
+    logdebug("cache: %s hits, %s misses" % (len(results), len(todo)))
+    computed = parallel_map(get_file_stats, list(todo), jobs=jobs,
+                            chunksize=PARALLEL_CHUNKSIZE,
+                            min_items=PARALLEL_MIN_FILES)
+    for file, result in computed:
+        if result is not False:
+            new_cache[todo[file]] = result
+            results.append((file, result))
+    if todo or len(new_cache) != len(cache):
+        save_state(cache_path, CACHE_VERSION, new_cache)
+    return results
+
+
+def get_git_stats():
+    """Collect the history stats with a single 'git log' pass over all
+    refs, parsed as it's streamed. Return a (commits, first_commit,
+    authors) tuple where 'first_commit' is the relative date of the
+    oldest commit and 'authors' maps each author name to a
+    [commits, lines_added, lines_removed] list.
+    """
+    # Every commit is a NUL-prefixed header line, followed by the
+    # "added<TAB>removed<TAB>path" lines of --numstat ("-" for
+    # binary files). Merges have no numstat.
+    cmd = ['git', 'log', '--all', '--numstat',
+           '--format=%x00%at%x00%ar%x00%aN']
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    commits = 0
+    first = None  # (timestamp, relative date)
+    authors = collections.defaultdict(lambda: [0, 0, 0])
+    author = None
+    for line in p.stdout:
+        if line.startswith(b'\0'):
+            timestamp, reldate, name = line[1:].rstrip(b'\n').split(b'\0')
+            commits += 1
+            author = authors[name.decode('utf8', 'replace')]
+            author[0] += 1
+            timestamp = int(timestamp)
+            if first is None or timestamp < first[0]:
+                first = (timestamp, reldate.decode('ascii'))
+        elif line != b'\n':
+            added, removed, _ = line.split(b'\t', 2)
+            if added != b'-':
+                author[1] += int(added)
+                author[2] += int(removed)
+    p.stdout.close()
+    p.wait()
+    return commits, first[1] if first else None, authors
+
+
+# --- history
+
+
+def iter_records(f, sep=b'\0'):
+    """Yield the 'sep' terminated records of the binary file 'f'
+    (e.g. the output of a git command run with -z), as it's streamed.
+    """
+    rest = b''
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        records = (rest + chunk).split(sep)
+        rest = records.pop()
+        for record in records:
+            yield record
+    if rest:
+        yield rest
+
+
+def iter_history(results, daily=False):
+    """Yield a (commit, timestamp, {ext: lines}) tuple for every commit
+    of the current branch (following first parents only), from the
+    oldest to the newest one.
+    Files are not read: starting from the current lines per ext
+    (computed by collect_stats(), minus the uncommitted changes) the
+    history is walked back with a single 'git log --numstat' pass
+    and the line deltas of every commit are subtracted, so the cost
+    depends on the size of the diffs, not on the number of commits
+    times the size of the tree.
+    With 'daily' only the last commit of every day is yielded.
+    """
+    lines = collections.defaultdict(int)
+    file_exts = {}  # file -> ext (None = binary)
+    for file, result in results:
+        file_exts[file] = result[0] if result else None
+        if result:
+            lines[result[0]] += result[1]
+
+    def get_ext(file):
+        try:
+            return file_exts[file]
+        except KeyError:
+            # not there anymore: guess by name only
+            ext = os.path.splitext(file)[1]
+            if ext in BINARY_EXTS:
+                return None
+            if not ext:
+                name = os.path.basename(file)
+                ext = name if name in KNOWN_BASENAMES else '(no-extension)'
+            return ext
+
+    def add_numstat(record, delta):
+        added, removed, file = record.split(b'\t', 2)
+        if added != b'-':  # binary
+            ext = get_ext(file.decode('utf8', 'replace'))
+            if ext is not None:
+                delta[ext] += int(added) - int(removed)
+
+    # -z so that paths are not quoted (as get_src_files() does), and
+    # --no-renames so that a file changing ext is seen as removed and
+    # added. The uncommitted changes come first.
+    changes = collections.defaultdict(int)
+    for record in subprocess.check_output(
+            ['git', 'diff', '-z', '--no-renames', '--numstat', 'HEAD']
+            ).split(b'\0'):
+        if record:
+            add_numstat(record, changes)
+    # Every commit is a "<sha> <timestamp>" record, followed by the
+    # "added<TAB>removed<TAB>path" records of --numstat (the first
+    # one prefixed by a newline) and an empty one.
+    cmd = ['git', 'log', '-z', '--first-parent', '-m', '--no-renames',
+           '--numstat', '--format=%H %ct', 'HEAD']
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    commits = []  # (commit, timestamp, {ext: delta}), newest first
+    delta = None
+    for record in iter_records(p.stdout):
+        record = record.lstrip(b'\n')
+        if b'\t' in record:
+            add_numstat(record, delta)
+        elif record:
+            commit, timestamp = record.split()
+            delta = collections.defaultdict(int)
+            commits.append((commit.decode('ascii'), int(timestamp), delta))
+    p.stdout.close()
+    p.wait()
+    logdebug("history: %s commits" % len(commits))
+
+    # the lines before the first commit, then forward
+    for ext, n in changes.items():
+        lines[ext] -= n
+    for commit, timestamp, delta in commits:
+        for ext, n in delta.items():
+            lines[ext] -= n
+
+    def day(timestamp):
+        return time.localtime(timestamp)[:3]
+
+    commits.reverse()
+    for i, (commit, timestamp, delta) in enumerate(commits):
+        for ext, n in delta.items():
+            lines[ext] += n
+        if daily and i + 1 < len(commits) and \
+                day(commits[i + 1][1]) == day(timestamp):
+            continue
+        yield commit, timestamp, dict(lines)
+
+
+def write_history(results, daily=False, fmt='csv'):
+    """Print iter_history() as CSV (one column per ext) or as JSON,
+    one object per line.
+    """
+    history = iter_history(results, daily=daily)
+    datefmt = '%Y-%m-%d' if daily else '%Y-%m-%d %H:%M:%S'
+    if fmt == 'json':
+        for commit, timestamp, lines in history:
+            print(json.dumps(dict(
+                commit=commit, date=time.strftime(
+                    datefmt, time.localtime(timestamp)),
+                lines=lines, total=sum(lines.values()))))
+        return
+    history = list(history)
+    exts = sorted(set(ext for _, _, lines in history for ext in lines))
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['commit', 'date'] + exts + ['total'])
+    for commit, timestamp, lines in history:
+        writer.writerow(
+            [commit, time.strftime(datefmt, time.localtime(timestamp))] +
+            [lines.get(ext, 0) for ext in exts] + [sum(lines.values())])
 
 
 def main():
@@ -252,47 +728,63 @@ def main():
     args = docopt(__doc__)
     DEBUG = args['--debug']
     VERBOSE = args['--verbose']
-    stats = collections.defaultdict(int)
+    jobs = int(args['--jobs']) if args['--jobs'] else 0
+    stats = collections.defaultdict(lambda: [0, 0, 0, 0])
+    if args['--history'] and not is_git():
+        sys.exit("--history requires a git repository")
     files = get_src_files()
 
     # collect stats
-    for i, file in enumerate(files):
-        if not istext(file):
-            continue
-        ext = get_file_ext(file)
-        stats[ext] += get_no_lines(file)
+    results = collect_stats(files, jobs=jobs)
+    if args['--history']:
+        return write_history(results, daily=args['--daily'],
+                             fmt='json' if args['--json'] else 'csv')
+    for file, result in results:
+        if result is not None:
+            ext = result[0]
+            if ext == '(no-extension)':
+                warn("can't recognize file %r" % file)
+            counts = stats[ext]
+            for i, n in enumerate(result[1:]):
+                counts[i] += n
 
     # calculate percent
     percent = {}
-    tot_lines = sum(stats.values())
-    for ext, lines in stats.items():
-        percent[ext] = round(lines / tot_lines * 100, 1)
+    totals = [sum(x) for x in zip(*stats.values())] or [0, 0, 0, 0]
+    tot_lines = totals[0]
+    for ext, counts in stats.items():
+        percent[ext] = round(counts[0] / tot_lines * 100, 1)
 
     # print stats
-    print("-" * 44)
-    print("ext                           lines        %")
-    print("-" * 44)
-    pairs = sorted(stats.items(), key=lambda (k, v): v)
-    for ext, lines in pairs:
-        print("%-18s %16s %7s%%" % (ext, lines, percent[ext]))
-    print("-" * 44)
-    print("lines:        %30s" % tot_lines)
-    print("files:        %30s" % len(files))
+    print("-" * 71)
+    print("ext                     lines       code    comment      blank"
+          "        %")
+    print("-" * 71)
+    pairs = sorted(stats.items(), key=lambda x: x[1][0])
+    for ext, (lines, code, comment, blank) in pairs:
+        print("%-18s %10s %10s %10s %10s %7s%%" % (
+            ext, lines, code, comment, blank, percent[ext]))
+    print("-" * 71)
+    print("lines:        %57s" % tot_lines)
+    print("code:         %57s" % totals[1])
+    print("comment:      %57s" % totals[2])
+    print("blank:        %57s" % totals[3])
+    print("files:        %57s" % len(files))
     if is_git():
-        print("commits:      %30s" % sh("git rev-list --all --count"))
-        committers = sh("git shortlog -sn")
-        first_cset = sh("git rev-list --max-parents=0 HEAD")
-        first_commit = sh(r"git show -s --format=%ar " + first_cset)
-        print("first commit:  %29s" % first_commit)
-        print("committers:   %30s" % len(committers.split('\n')))
+        commits, first_commit, authors = get_git_stats()
+        print("commits:      %57s" % commits)
+        if first_commit:
+            print("first commit:  %56s" % first_commit)
+        print("committers:   %57s" % len(authors))
+        # like "git shortlog -sn"
+        committers = sorted(authors.items(), key=lambda x: (-x[1][0], x[0]))
         if not VERBOSE:
             print("top 5 committers: ")
-            committers = committers.split('\n')[:5]
-        else:
-            committers = committers.split('\n')
-        for line in committers:
-            commits, author = line.strip().split('\t')
-            print("  %-30s %11s" % (author, commits))
+            committers = committers[:5]
+        for author, (commits, added, removed) in committers:
+            print("  %-30s %11s %10s %10s" % (
+                author, commits, "+%s" % added, "-%s" % removed))
 
 
-main()
+if __name__ == '__main__':
+    main()
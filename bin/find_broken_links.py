@@ -8,12 +8,16 @@
 Look for broken urls in files.
 
 Usage:
-    find_broken_links.py [-v] [-u] [-t <secs>] <file>...
+    find_broken_links.py [-v] [-u] [-t <secs>] [-c <n>] [-j <n>] <file>...
 
 Options:
     -v --verbose           # more verbose output
     -u --urls-only         # just print urls and exit
     -t --timeout <secs>    # HTTP request timeout
+    -c --per-host <n>      # max concurrent connections per host;
+                           # default=8
+    -j --jobs <n>          # max concurrent requests overall;
+                           # default=200
 
 Example for checking all text files of a GIT project:
     git grep --cached -Il '' | xargs find_broken_links.py
@@ -21,20 +25,23 @@ Example for checking all text files of a GIT project:
 
 
 from __future__ import print_function
-import os
+import asyncio
+import collections
 import re
-import socket
+import ssl
 import sys
-from concurrent.futures import ThreadPoolExecutor
-try:
-    from urllib2 import urlopen, Request
-except ImportError:
-    from urllib.request import urlopen, Request
+from urllib.parse import quote, urljoin, urlsplit
 
 from docopt import docopt
 
 
 SOCKET_TIMEOUT = 5
+MAX_PER_HOST = 8
+MAX_IN_FLIGHT = 200
+MAX_REDIRECTS = 10  # same as urllib
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+USER_AGENT = 'Python-urllib/%s.%s' % sys.version_info[:2]
 VERBOSE = False
 NUM_PROCESSED = 0
 
@@ -97,25 +104,205 @@ def find_urls(file):
             yield url
 
 
-def try_url(url, total):
-    global NUM_PROCESSED
+# ===================================================================
+# HTTP client
+# ===================================================================
+
+
+class ConnectionPool(object):
+    """A minimal asyncio HTTP/1.1 client keeping keep-alive connections
+    pooled per (scheme, host, port). At most 'per_host' connections
+    per host and 'max_in_flight' requests overall are active at any
+    time.
+    """
+
+    def __init__(self, per_host=MAX_PER_HOST, max_in_flight=MAX_IN_FLIGHT,
+                 timeout=SOCKET_TIMEOUT):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.hosts = {}  # (scheme, host, port) -> (semaphore, [idle conn])
+        self.connections = 0  # total connections opened
+        self._ssl_ctx = None
+
+    def _get_host(self, key):
+        try:
+            return self.hosts[key]
+        except KeyError:
+            ret = self.hosts[key] = (asyncio.Semaphore(self.per_host), [])
+            return ret
+
+    async def _connect(self, scheme, host, port):
+        ssl_ctx = None
+        if scheme == 'https':
+            if self._ssl_ctx is None:
+                self._ssl_ctx = ssl.create_default_context()
+            ssl_ctx = self._ssl_ctx
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_ctx), self.timeout)
+        self.connections += 1
+        return conn
+
+    async def _roundtrip(self, reader, writer, req):
+        """Send a request, read the response head and return a
+        (status, reason, headers, keepalive) tuple.
+        """
+        writer.write(req)
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by peer")
+        version, status, reason = (line.decode('latin1').rstrip('\r\n') +
+                                   '  ').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionResetError("connection closed by peer")
+            if line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.decode('latin1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        conn_hdr = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keepalive = conn_hdr != 'close'
+        else:
+            keepalive = conn_hdr == 'keep-alive'
+        return int(status), reason.strip(), headers, keepalive
 
-    class HeadRequest(Request):
-        def get_method(self):
-            return "HEAD"
+    async def request(self, method, url):
+        """Send a body-less request and return a (status, reason,
+        headers) tuple, reusing an idle connection to the same host if
+        there is one. A reused connection which turns out to be closed
+        by the server is replaced by a new one.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS:
+            raise ValueError("unsupported scheme %r" % scheme)
+        host = parts.hostname
+        port = parts.port or DEFAULT_PORTS[scheme]
+        target = quote(parts.path or '/', safe="/%;:@&=+$,!~*'()")
+        if parts.query:
+            target += '?' + quote(parts.query, safe="/%;:@&=+$,!~*'()?")
+        req = ("%s %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\n"
+               "Accept: */*\r\nConnection: keep-alive\r\n\r\n" % (
+                   method, target, parts.netloc.rpartition('@')[2],
+                   USER_AGENT)).encode('latin1')
+        sem, idle = self._get_host((scheme, host, port))
+        async with sem:
+            async with self.in_flight:
+                while True:
+                    reused = bool(idle)
+                    if reused:
+                        reader, writer = idle.pop()
+                    else:
+                        reader, writer = await self._connect(
+                            scheme, host, port)
+                    try:
+                        status, reason, headers, keepalive = \
+                            await asyncio.wait_for(
+                                self._roundtrip(reader, writer, req),
+                                self.timeout)
+                    except (ConnectionError, asyncio.IncompleteReadError):
+                        writer.close()
+                        if reused:
+                            continue
+                        raise
+                    except BaseException:
+                        writer.close()
+                        raise
+                    if keepalive:
+                        idle.append((reader, writer))
+                    else:
+                        writer.close()
+                    return status, reason, headers
+
+    def close(self):
+        for sem, idle in self.hosts.values():
+            for reader, writer in idle:
+                writer.close()
+            del idle[:]
+
+
+# ===================================================================
+# implementation
+# ===================================================================
+
+
+async def try_url(pool, url, total):
+    """Send a HEAD request for 'url' (following redirects) and return
+    an error string if it's broken, else None.
+    """
+    global NUM_PROCESSED
 
-    err = None
+    orig_url = url
     try:
-        resp = urlopen(HeadRequest(url))
+        for _ in range(MAX_REDIRECTS + 1):
+            status, reason, headers = await pool.request('HEAD', url)
+            if status in REDIRECT_CODES and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if status == 200:
+                return None
+            elif 200 <= status < 300:
+                return "code == %s" % status
+            else:
+                return "HTTP Error %s: %s" % (status, reason)
+        return "too many redirects"
+    except asyncio.TimeoutError:
+        return "timed out"
     except Exception as err:
-        return str(err)
-    else:
-        if resp.code != 200:
-            return "code == %s" % resp.code
+        return str(err) or err.__class__.__name__
     finally:
         NUM_PROCESSED += 1
         if VERBOSE:
-            print("%s/%s %s" % (NUM_PROCESSED, total, url))
+            print("%s/%s %s" % (NUM_PROCESSED, total, orig_url))
+
+
+async def _check_urls(urls, pool):
+    # Group URLs by host and run at most 'per_host' workers per host,
+    # so that the number of tasks doesn't grow with the number of URLs
+    # and workers don't hold global slots waiting for a busy host.
+    errors = {}
+    byhost = collections.defaultdict(collections.deque)
+    for url in urls:
+        parts = urlsplit(url)
+        byhost[(parts.scheme.lower(), parts.netloc.lower())].append(url)
+
+    async def worker(queue):
+        while queue:
+            url = queue.popleft()
+            err = await try_url(pool, url, len(urls))
+            if err:
+                errors[url] = err
+
+    workers = []
+    for queue in byhost.values():
+        for _ in range(min(pool.per_host, len(queue))):
+            workers.append(worker(queue))
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        pool.close()
+    return errors
+
+
+def check_urls(urls, timeout=SOCKET_TIMEOUT, per_host=MAX_PER_HOST,
+               max_in_flight=MAX_IN_FLIGHT):
+    """Check 'urls' concurrently over per-host keep-alive connections
+    and return an (errors, connections) tuple, where 'errors' is a
+    {url: error} dict of the broken ones and 'connections' how many
+    connections were opened. Any http(s) server will do, e.g. a local
+    one for testing.
+    """
+    async def run():
+        pool = ConnectionPool(per_host=per_host, max_in_flight=max_in_flight,
+                              timeout=timeout)
+        errors = await _check_urls(urls, pool)
+        return errors, pool.connections
+
+    return asyncio.run(run())
 
 
 def main(argv=None):
@@ -124,8 +311,9 @@ def main(argv=None):
     args = docopt(__doc__, argv=argv)
     files = args['<file>']
     timeout = int(args['--timeout'] or 0) or SOCKET_TIMEOUT
+    per_host = int(args['--per-host'] or 0) or MAX_PER_HOST
+    max_in_flight = int(args['--jobs'] or 0) or MAX_IN_FLIGHT
     VERBOSE = args['--verbose']
-    socket.setdefaulttimeout(timeout)
     urls = set()
 
     # find urls
@@ -141,15 +329,16 @@ def main(argv=None):
         return
 
     # inspect them
-    futs = {}
-    urls = sorted(urls)
-    with ThreadPoolExecutor(max_workers=200) as ex:
-        for url in urls:
-            futs[url] = ex.submit(try_url, url, len(urls))
+    errors, connections = check_urls(
+        urls, timeout=timeout, per_host=per_host,
+        max_in_flight=max_in_flight)
+    if VERBOSE:
+        print("%s urls checked using %s connections" % (
+            len(urls), connections))
 
     # done, print results
     for url in urls:
-        err = futs[url].result()
+        err = errors.get(url)
         if err:
             print("%s %s" % (url, hilite(err, ok=False)))
 
@@ -158,4 +347,4 @@ if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
-        os._exit(0)  # quick & dirty way to kill the thread pool
+        sys.exit(0)
@@ -4,52 +4,195 @@
 # Use of this source code is governed by a BSD-style license.
 
 # TODO: implement AND logic, not only OR
-# TODO: regular expressions?
 
 """
 Recursively search a string occurrence in all files of this directory.
 Similar to "ack" (https://beyondgrep.com/), just simpler.
+It can also be used as a library, see iter_matches().
 Features:
  * simple search
  * case insensitive search
+ * regular expressions
  * search & replacelp
  * logical AND search for multiple patterns on the same line
  * colors
  * open in system editor
+ * binary files are skipped, non UTF-8 text files are decoded
 
 Usage:
-    grep.py [-r] [-i] [-o] [-n <N>] [-e <EXTS>] <pattern> ...
+    grep.py [-r] [-i] [-E] [-o] [-n <N>] [-e <EXTS>] [-j <N>] [-t <N>]
+            [--index] [--dry-run] [-l | -c] [-m <N>] [-z] [--json | -0]
+            [--client]
+            <pattern> ...
+    grep.py --serve [--max-memory=<MB>]
 
 Options:
     -r --replace              # replace 2 patterns
+    --dry-run                 # with --replace, print a diff of the changes
+                              # instead of writing files
     -i --ignore-case          # case insensitive
+    -E --regex                # <pattern>s are regular expressions
     -e <EXTS> --exts=<EXTS>   # a list of comma separated extensions;
                               # default=%s
     -o --open                 # open files in editor
     -n <N> --nlines=<N>       # number of lines to print above and below
+    -l --files-with-matches   # only print the names of matching files
+    -c --count                # only print the number of matching lines
+                              # per file
+    -m <N> --max-count=<N>    # stop reading a file after N matching lines
+    -z --decompress           # also search inside gzip, bzip2 and xz
+                              # compressed files (e.g. rotated logs)
+    --json                    # print results as JSON, one object per line
+                              # ("spans" are char offsets into "line",
+                              # "byte_spans" byte offsets)
+    -0 --null                 # no colors, end file names with a NUL byte
+                              # (for "xargs -0")
+    -j <N> --jobs=<N>         # number of worker processes (0 = num CPUs);
+                              # default=1
+    -t <N> --threads=<N>      # number of threads listing directories
+                              # ahead of time (useful on network file
+                              # systems); default=1
+    --index                   # use a persistent trigram index (stored in
+                              # .git or ~/.cache) to skip files which
+                              # can't match
+    --serve                   # run a daemon keeping the files of this
+                              # directory in memory, for --client
+    --max-memory=<MB>         # the max size of the file contents cached
+                              # by --serve; default=512
+    --client                  # search through the --serve daemon
 
 Examples:
     grep.py -e py,c,h pattern  # search for specific extensions
     grep.py foo bar            # search for 'foo' AND 'bar' on the same line
+    grep.py -E 'def \\w+_file'  # search for a regular expression
     grep.py -r foo bar         # replaces 'foo' with 'bar'
+    grep.py -r foo bar --dry-run  # show what would be replaced
     grep.py foo -n 5           # prints the 5 lines before and after the match
     grep.py foo -o             # open matching files in system editor
+    grep.py -l foo             # list the files containing 'foo'
+    grep.py -z -e log error    # search into app.log, app.log.1.gz, ...
+    grep.py -l -0 foo | xargs -0 ls -l
+    grep.py foo -j 0           # search using all CPUs
+    grep.py foo --index        # fast repeated searches on big trees
+    grep.py --serve &          # searches in milliseconds with --client
+    grep.py foo --client
 """
 
 from __future__ import print_function
+import bz2
+import codecs
 import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import functools
+import gzip
+import io
+import itertools
+import json
+import mmap
+import operator
 import os
+import re
+import select
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import time
 
 from docopt import docopt
 
+from sysconf import get_state_path
+from sysconf import iter_blocks
+from sysconf import load_state
+from sysconf import parallel_map
+from sysconf import save_state
+from sysconf import walk_files
+
+try:
+    import lzma  # Python >= 3.3
+except ImportError:
+    lzma = None
+
+try:
+    from re import _parser as sre_parse  # Python >= 3.11
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_constants
+    import sre_parse
+
 
 PY3 = sys.version_info[0] == 3
 if PY3:
     basestring = str
     raw_input = input
+    unichr = chr
 TERMINAL_SIZE_FALLBACK = 2
+ENCODING = 'utf8'
+CHUNK_SIZE = 1024 * 1024
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# Below this number of files the tree is searched serially, as it's
+# not worth paying the startup cost of the worker processes.
+PARALLEL_MIN_FILES = 200
+PARALLEL_CHUNKSIZE = 16
+INDEX_VERSION = 2
+# Bigger files are not indexed and are always searched.
+INDEX_MAX_FILE_SIZE = 16 * 1024 * 1024
+TRIGRAM_RE = re.compile(b'...', re.DOTALL)
+# The --serve daemon caches up to this many bytes of file contents.
+SERVER_MAX_MEMORY = 512 * 1024 * 1024
+# Without inotify the daemon walks the tree again before a query if
+# the last walk is older than this (seconds).
+POLL_INTERVAL = 2
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+# events changing the list of files, rather than their content
+IN_TREE_CHANGED = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                   IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED)
+# magic bytes -> function opening the file for decompression
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.BZ2File),
+    (b'\xfd7zXZ\x00', lzma.open if lzma is not None else None),
+]
+COMPRESSED_EXTS = set(['.gz', '.bz2', '.xz'])
+# log rotation suffixes, as in "app.log.1" or "app.log-20160101"
+ROTATION_SUFFIX_RE = re.compile(r'(\.\d+|-\d{8})$')
+DECOMPRESSION_ERRORS = (EnvironmentError, EOFError)
+if lzma is not None:
+    DECOMPRESSION_ERRORS += (lzma.LZMAError, )
+MAGIC_SIZE = 6
+# Files are classified as binary or text (and their encoding guessed)
+# by looking at their first SNIFF_SIZE bytes.
+SNIFF_SIZE = 8192
+SNIFF_CACHE_SIZE = 100000
+# BOM -> encoding (UTF-32 first as its LE BOM starts with UTF-16's)
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+# tried in order when a text file is not valid UTF-8
+FALLBACK_ENCODINGS = ['cp1252', 'latin1']
+# control chars which are common in text files
+TEXT_CHARS = bytes(bytearray([7, 8, 9, 10, 12, 13, 27] + list(range(32, 256))))
 DEFAULT_EXTS = [
     'c',
     'cpp'
@@ -71,6 +214,7 @@ IGNORE_ROOT_DIRS = [
     '.git',
     'build',
     'dist',
+    '*.egg-info',
 ]
 __doc__ = __doc__ % str(tuple(DEFAULT_EXTS))
 
@@ -147,7 +291,7 @@ def get_terminal_size():
         except Exception:
             return TERMINAL_SIZE_FALLBACK
     else:
-        gts(fallback=(TERMINAL_SIZE_FALLBACK, 0))[0]
+        return gts(fallback=(TERMINAL_SIZE_FALLBACK, 0))[0]
 
 
 TERMINAL_SIZE = get_terminal_size()
@@ -218,6 +362,10 @@ def exit(msg):
     sys.exit(1)
 
 
+def warn(msg):
+    print(hilite(msg, ok=False), file=sys.stderr)
+
+
 def open_file(path):
     cmd = get_editor_cmd()
     subprocess.call(cmd + [path])
@@ -228,132 +376,1566 @@ def open_file(path):
 # ===================================================================
 
 
-def grep_file(filepath, patterns, replace=False, ignore_case=False,
-              nlines=0):
-    def get_file_content():
-        with open(filepath, 'r') as f:
-            data = f.read()
+class Matcher(object):
+    """Search raw bytes for lines containing all the given patterns.
+    The buffer is scanned for a single "needle" (the longest pattern,
+    which is usually the rarest one). The lines containing it are
+    then matched against all the patterns at once by a single
+    compiled alternation, which also returns the spans to highlight.
+    """
+
+    def __init__(self, patterns, ignore_case=False):
+        self.patterns = patterns
+        self.ignore_case = ignore_case
+        bpatterns = sorted(set(x.encode(ENCODING) for x in patterns),
+                           key=len, reverse=True)
+        self.literals = patterns
+        self._needle = bpatterns[0]
+        self._needle_re = None
         if ignore_case:
-            data = data.lower()
-        return data
+            self._needle_re = re.compile(icase_pattern(bpatterns[0]))
+        # A pattern which is a substring of another one is implied
+        # by it and doesn't need to be looked for. This guarantees
+        # that no 2 patterns can match at the same offset.
+        folded = [decode(x).lower() if ignore_case else x
+                  for x in bpatterns]
+        required = [x for i, x in enumerate(bpatterns)
+                    if not any(folded[i] in y for y in folded[:i])]
+        # Every alternative is wrapped in a lookahead so that
+        # overlapping occurrences are found as well, and has its own
+        # group so that m.lastindex tells which pattern matched.
+        alts = [icase_pattern(x) if ignore_case else re.escape(x)
+                for x in required]
+        self._finditer = re.compile(
+            b'(?=(' + b')|('.join(alts) + b'))').finditer
+        self._nrequired = len(required)
+        # The cheap tests used by test_line(): the needle was already
+        # found so only the other patterns are checked.
+        self._tests = []
+        for x in required:
+            if x != self._needle:
+                if ignore_case:
+                    self._tests.append(re.compile(icase_pattern(x)).search)
+                else:
+                    self._tests.append(lambda line, x=x: x in line)
+        # If True any line containing the needle is a match.
+        self.needle_only = not self._tests
 
-    def print_pre_lines(lines, orig_pos):
-        curr_pos = orig_pos - nlines
-        print("." * TERMINAL_SIZE)
-        while curr_pos < 0 or curr_pos < orig_pos:
-            try:
-                if curr_pos < 0:
-                    continue
-                line = lines[curr_pos]
-            except KeyError:
-                pass
-            else:
-                print("%s: %s" % (
-                    hilite(curr_pos + 1, ok=None, bold=True), line.rstrip()))
-            finally:
-                curr_pos += 1
+    def search(self, buf, pos):
+        """Return the offset of the next needle occurrence in 'buf'
+        starting from 'pos', or -1.
+        """
+        if self._needle_re is not None:
+            m = self._needle_re.search(buf, pos)
+            return m.start() if m is not None else -1
+        return buf.find(self._needle, pos)
 
-    def print_post_lines(lines, orig_pos):
-        curr_pos = orig_pos
-        exit_at = curr_pos + nlines
-        while curr_pos != exit_at:
-            try:
-                if curr_pos < 0:
-                    continue
-                line = lines[curr_pos]
-            except IndexError:
-                # We reached the end of lines
+    def match_line(self, line):
+        """If the line contains all the patterns return the list of
+        (start, end) spans where they occur, else None.
+        """
+        spans = []
+        found = set()
+        for m in self._finditer(line):
+            group = m.lastindex
+            found.add(group)
+            spans.append(m.span(group))
+        if len(found) < self._nrequired:
+            return None
+        return spans
+
+    def test_line(self, line):
+        """Like match_line() but only tell whether a line containing
+        the needle matches, without computing any span.
+        """
+        for test in self._tests:
+            if not test(line):
+                return False
+        return True
+
+
+class RegexMatcher(Matcher):
+    """Like Matcher but 'patterns' are regular expressions, all of
+    which must match the line. The literal strings any match must
+    contain are extracted from the regexes and the longest one is
+    used as the needle, so the regex engine only runs against the
+    lines which can match. With no literals every line is a
+    candidate.
+    """
+
+    def __init__(self, patterns, ignore_case=False):
+        self.patterns = patterns
+        flags = re.IGNORECASE if ignore_case else 0
+        self._regexes = [re.compile(x, flags) for x in patterns]
+        # Literals coming from case insensitive regexes only count as
+        # case insensitive needles.
+        literals = []
+        for regex in self._regexes:
+            icase = bool(regex.flags & re.IGNORECASE)
+            for literal in get_regex_literals(regex.pattern):
+                literals.append((len(literal.encode(ENCODING)), icase,
+                                 literal))
+        self.literals = [x[2] for x in literals]
+        self.ignore_case = any(x[1] for x in literals)
+        self.needle_only = False
+        self._needle = b''
+        self._needle_re = None
+        if literals:
+            _, icase, literal = max(literals)
+            self._needle = literal.encode(ENCODING)
+            if icase:
+                self._needle_re = re.compile(icase_pattern(self._needle))
+
+    def match_line(self, line):
+        text = decode(line)
+        spans = []
+        for regex in self._regexes:
+            matches = [m.span() for m in regex.finditer(text)]
+            if not matches:
+                return None
+            spans.extend(matches)
+        # chars -> bytes offsets
+        return [(len(text[:x].encode(ENCODING)),
+                 len(text[:y].encode(ENCODING))) for x, y in spans]
+
+    def test_line(self, line):
+        text = decode(line)
+        for regex in self._regexes:
+            if regex.search(text) is None:
+                return False
+        return True
+
+
+def get_regex_literals(pattern):
+    """Return the literal strings which any match of 'pattern' must
+    contain, e.g. 'def \\w+_file(s)?' -> ['def ', '_file'].
+    Only concatenations, groups and repetitions of at least 1 are
+    followed; alternations and optional parts are skipped.
+    """
+    literals = []
+    repeats = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+               getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
+
+    def walk(subpattern):
+        run = []
+        for op, av in subpattern:
+            if op == sre_constants.LITERAL:
+                run.append(unichr(av))
+                continue
+            if run:
+                literals.append(''.join(run))
+                run = []
+            if op == sre_constants.SUBPATTERN:
+                add_flags = av[1] if len(av) == 4 else 0
+                if not add_flags:  # e.g. (?i:...)
+                    walk(av[-1])
+            elif op in repeats and av[0] >= 1:
+                walk(av[2])
+        if run:
+            literals.append(''.join(run))
+
+    walk(sre_parse.parse(pattern))
+    return literals
+
+
+@memoize
+def get_matcher(patterns, ignore_case=False, regex=False):
+    klass = RegexMatcher if regex else Matcher
+    return klass(list(patterns), ignore_case=ignore_case)
+
+
+def icase_pattern(bpattern):
+    """Turn a bytes pattern into a case insensitive bytes regex.
+    Every char is expanded into its lower/upper case variants
+    *before* being encoded, so that non-ASCII letters match too.
+    """
+    parts = []
+    for char in bpattern.decode(ENCODING):
+        variants = set([char, char.lower(), char.upper()])
+        if len(variants) == 1:
+            parts.append(re.escape(char.encode(ENCODING)))
+        else:
+            parts.append(b'(?:' + b'|'.join(
+                re.escape(x.encode(ENCODING)) for x in sorted(variants)) +
+                b')')
+    return b''.join(parts)
+
+
+@contextlib.contextmanager
+def map_file(f):
+    """Memory-map a file object and return a read-only buffer which
+    can be searched without copying it in memory. Fallback on a plain
+    read() for files which can't be mapped (empty files, pipes, etc.).
+    """
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        yield f.read()
+    else:
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+@contextlib.contextmanager
+def open_buffer(filepath):
+    """Like map_file() but takes a path."""
+    with open(filepath, 'rb') as f:
+        with map_file(f) as buf:
+            yield buf
+
+
+def count_newlines(buf, start, end):
+    """Count the line feeds in buf[start:end] by copying at most
+    CHUNK_SIZE bytes at a time.
+    """
+    count = 0
+    while start < end:
+        stop = min(start + CHUNK_SIZE, end)
+        count += buf[start:stop].count(b'\n')
+        start = stop
+    return count
+
+
+def iter_candidate_lines(buf, matcher):
+    """Yield the (start, end) offsets of the lines of 'buf' containing
+    the needle of 'matcher'. Line boundaries are located only around
+    the hits, so a file with no match costs one linear scan of the
+    buffer.
+    """
+    size = len(buf)
+    pos = 0  # always the start of a line
+    while pos < size:
+        hit = matcher.search(buf, pos)
+        if hit == -1:
+            return
+        idx = buf.rfind(b'\n', pos, hit)
+        start = pos if idx == -1 else idx + 1
+        end = buf.find(b'\n', hit)
+        if end == -1:
+            end = size
+        yield start, end
+        pos = end + 1
+
+
+def iter_matching_lines(buf, matcher):
+    """Yield a (lineno, offset, line, spans) tuple for every line of
+    'buf' matching 'matcher'. Only the candidate lines are copied.
+    """
+    pos = 0
+    lineno = 1  # the line number of 'pos'
+    for start, end in iter_candidate_lines(buf, matcher):
+        lineno += count_newlines(buf, pos, start)
+        line = buf[start:end]
+        spans = matcher.match_line(line)
+        if spans is not None:
+            yield lineno, start, line, spans
+        lineno += 1
+        pos = end + 1
+
+
+def count_matching_lines(buf, matcher, max_count=0):
+    """Return the number of lines of 'buf' matching 'matcher',
+    stopping at 'max_count' (if any). Line numbers and spans are not
+    computed, and lines are not even copied if the needle is the
+    only thing to look for.
+    """
+    count = 0
+    for start, end in iter_candidate_lines(buf, matcher):
+        if matcher.needle_only or matcher.test_line(buf[start:end]):
+            count += 1
+            if count == max_count:
                 break
+    return count
+
+
+def iter_lines(buf):
+    """Iterate over the lines of a buffer (without line feeds)."""
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        end = buf.find(b'\n', pos)
+        if end == -1:
+            end = size
+        yield buf[pos:end]
+        pos = end + 1
+
+
+def iter_context(lines, matcher, nlines, max_count=0):
+    """Like iter_matching_lines() but also yield the 'nlines' lines
+    before and after each match, as (lineno, offset, line, None)
+    tuples. If 'max_count' is given stop after that many matches (and
+    their trailing context).
+    Overlapping context windows are merged: each line is yielded at
+    most once, like GNU grep does.
+    Lines are streamed: the previous lines are kept in a ring buffer
+    of 'nlines' length and the following ones are tracked by a
+    counter, so memory usage doesn't depend on the file size.
+    """
+    before = collections.deque(maxlen=nlines)
+    after = 0  # how many lines still to yield after the last match
+    count = 0
+    offset = 0
+    for lineno, line in enumerate(lines, 1):
+        if count == max_count and count:
+            if not after:
+                return
+            yield lineno, offset, line, None
+            after -= 1
+        else:
+            spans = None
+            if matcher.search(line, 0) != -1:
+                spans = matcher.match_line(line)
+            if spans is not None:
+                count += 1
+                for item in before:
+                    yield item
+                before.clear()
+                yield lineno, offset, line, spans
+                after = nlines
+            elif after:
+                yield lineno, offset, line, None
+                after -= 1
             else:
-                print("%s: %s" % (
-                    hilite(curr_pos + 1, ok=None, bold=True),
-                    line.rstrip()))
-            finally:
-                curr_pos += 1
+                before.append((lineno, offset, line, None))
+        offset += len(line) + 1
 
-    def find_occurrences(lines, patterns):
-        if not isinstance(lines, list):
-            # probably a file object
-            lines = list(lines)
-        occurrences = 0
-        header_printed = False
-        for lineno, line in enumerate(lines, 1):
-            for pattern in patterns:
-                # lowercase() the line on the fly, but we want to keep
-                # the original one around in order to print it.
-                temp_line = line if not ignore_case else line.lower()
-                if pattern not in temp_line:
+
+# --- compressed files
+
+
+def get_decompressor(head):
+    """Given the first bytes of a file return the function to open it
+    for decompression, or None if it's not compressed.
+    """
+    for magic, opener in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def iter_matching_blocks(blocks, matcher):
+    """Like iter_matching_lines() for an iterable of blocks of whole
+    lines (see iter_blocks()).
+    """
+    base = 0  # the number of lines in the previous blocks
+    base_offset = 0
+    for block in blocks:
+        for lineno, offset, line, spans in iter_matching_lines(
+                block, matcher):
+            yield base + lineno, base_offset + offset, line, spans
+        base += block.count(b'\n')
+        base_offset += len(block)
+
+
+def count_matching_blocks(blocks, matcher, max_count=0):
+    count = 0
+    for block in blocks:
+        count += count_matching_lines(
+            block, matcher, max_count=max_count - count if max_count else 0)
+        if max_count and count >= max_count:
+            break
+    return count
+
+
+def decode(data, encoding=ENCODING):
+    return data.decode(encoding, 'replace')
+
+
+# --- binary / encoding sniffing
+
+_sniff_cache = {}
+
+
+def sniff(head):
+    """Classify the first bytes of a file: return None if it looks
+    like a binary file, else the encoding to decode it with.
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    if b'\0' in head:
+        return None
+    # Like file(1): binary if more than 30% of the chars are
+    # unusual control chars.
+    if len(head.translate(None, TEXT_CHARS)) > len(head) * 0.3:
+        return None
+    try:
+        # Not final: the block may end in the middle of a char.
+        codecs.getincrementaldecoder(ENCODING)().decode(head)
+        return ENCODING
+    except UnicodeDecodeError:
+        pass
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            head.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+
+
+def sniff_file(f):
+    """Return the sniff() verdict for an open file, reading at most
+    SNIFF_SIZE bytes. Verdicts are cached by (device, inode, mtime) so
+    a file is not read again until it changes (e.g. by --serve).
+    """
+    st = os.fstat(f.fileno())
+    key = (st.st_dev, st.st_ino, st.st_mtime)
+    try:
+        return _sniff_cache[key]
+    except KeyError:
+        pass
+    encoding = sniff(f.read(SNIFF_SIZE))
+    f.seek(0)
+    if len(_sniff_cache) >= SNIFF_CACHE_SIZE:
+        _sniff_cache.clear()
+    _sniff_cache[key] = encoding
+    return encoding
+
+
+def transcode(data, encoding):
+    """Convert text from 'encoding' to UTF-8, so that it can be
+    searched (and printed) like the rest.
+    """
+    return data.decode(encoding, 'replace').encode(ENCODING)
+
+
+def hilite_spans(line, spans):
+    """Decode a line of bytes highlighting the (start, end) spans."""
+    parts = []
+    pos = 0
+    for start, end in sorted(spans):
+        start = max(start, pos)
+        if end <= start:
+            continue
+        parts.append(decode(line[pos:start]))
+        parts.append(hilite(decode(line[start:end])))
+        pos = end
+    parts.append(decode(line[pos:]))
+    return ''.join(parts)
+
+
+# --- replace
+
+
+def write_chunks(f, buf, start, end):
+    """Write buf[start:end] to a file, CHUNK_SIZE bytes at a time."""
+    while start < end:
+        stop = min(start + CHUNK_SIZE, end)
+        f.write(buf[start:stop])
+        start = stop
+
+
+def replace_in_file(filepath, buf, src, dst):
+    """Replace all 'src' occurrences found in 'buf' (the content of
+    'filepath') with 'dst' and return how many there were.
+    The new content is streamed into a temporary file in the same
+    directory which is then renamed over the original one, so a
+    crash never leaves a truncated file behind. Symlinks are resolved
+    first, so that the file they point to is replaced rather than the
+    link itself. Permissions and (if allowed) ownership are kept.
+    """
+    filepath = os.path.realpath(filepath)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath),
+                               prefix='.grep.py-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            occurrences = 0
+            pos = 0
+            while True:
+                idx = buf.find(src, pos)
+                if idx == -1:
                     break
-            else:
-                if not header_printed:
-                    print(hilite(filepath, bold=True))
-                    header_printed = True
-                # Print the N lines previous to this match.
-                if nlines:
-                    print_pre_lines(lines, lineno - 1)
-                # Note: if case-sensitive, this may not highlight the
-                # line (well... who cares =)).
-                for pattern in patterns:
-                    line = line.replace(pattern, hilite(pattern))
-                print("%s: %s" % (
-                    hilite(lineno, ok=None, bold=True), line.rstrip()))
-                # Print the N lines post to this match.
-                if nlines:
-                    print_post_lines(lines, lineno)
+                write_chunks(f, buf, pos, idx)
+                f.write(dst)
+                pos = idx + len(src)
                 occurrences += 1
-        if occurrences:
-            print()
-        return occurrences
+            write_chunks(f, buf, pos, len(buf))
+            f.flush()
+            os.fsync(f.fileno())
+        st = os.stat(filepath)
+        shutil.copymode(filepath, tmp)
+        if hasattr(os, 'chown'):
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except OSError:
+                pass  # not root; the file is now owned by us
+        os.rename(tmp, filepath)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return occurrences
 
-    def find_single_pattern(pattern):
-        assert isinstance(pattern, basestring)
-        data = get_file_content()
-        occurrences = 0
-        if pattern in data:
-            lines = data.splitlines()
-            occurrences += find_occurrences(lines, patterns)
-        return occurrences
-
-    def find_multi_patterns(patterns):
-        assert isinstance(patterns, list)
-        if replace and len(patterns) != 2:
-            exit("with --replace you must specifcy 2 <pattern>s")
-        with open(filepath, 'r') as f:
-            occurrences = find_occurrences(f, set(patterns))
-        return occurrences
-
-    def replace_patterns(patterns):
-        with open(filepath, 'r') as f:
-            data = f.read()
-        src, dst = patterns
-        new_data = data.replace(src, dst)
-        occurrences = 0
-        if data != new_data:
-            occurrences = data.count(src)
-            print("%s (%s occurrences)" % (
-                hilite(filepath, bold=True), hilite(occurrences)))
-            with open(filepath, 'w') as f:
-                f.write(new_data)
-        return occurrences
 
+def iter_replace_hunks(buf, src, dst):
+    """Yield the unified diff hunks which replacing 'src' with 'dst'
+    in 'buf' would produce, as (old_start, old_lines, new_start,
+    new_lines) tuples. Only the lines around the hits are looked at
+    and adjacent changed lines are merged into the same hunk.
+    """
+    def line_end(pos):
+        idx = buf.find(b'\n', pos)
+        return len(buf) if idx == -1 else idx
+
+    hunk = None
+    pos = 0  # always the start of a line
+    lineno = 1  # the line number of 'pos'
+    delta = 0  # new line numbers - old line numbers
+    while True:
+        hit = buf.find(src, pos)
+        if hit == -1:
+            break
+        idx = buf.rfind(b'\n', pos, hit)
+        start = pos if idx == -1 else idx + 1
+        # a multi-line 'src' may span several lines
+        end = line_end(hit + len(src))
+        nxt = buf.find(src, hit + len(src))
+        while nxt != -1 and nxt <= end:
+            end = line_end(nxt + len(src))
+            nxt = buf.find(src, nxt + len(src))
+        lineno += count_newlines(buf, pos, start)
+        old = buf[start:end]
+        old_lines = old.split(b'\n')
+        new_lines = old.replace(src, dst).split(b'\n')
+        if hunk is not None and hunk[0] + len(hunk[1]) == lineno:
+            hunk[1].extend(old_lines)
+            hunk[3].extend(new_lines)
+        else:
+            if hunk is not None:
+                yield hunk
+            hunk = (lineno, old_lines, lineno + delta, new_lines)
+        delta += len(new_lines) - len(old_lines)
+        lineno += len(old_lines)
+        pos = end + 1
+    if hunk is not None:
+        yield hunk
+
+
+def check_patterns(patterns, replace=False, ignore_case=False,
+                   regex=False):
+    if regex:
+        if replace:
+            exit("can't use --regex with --replace")
+        for pattern in patterns:
+            try:
+                re.compile(pattern)
+            except re.error as err:
+                exit("invalid regex %r: %s" % (pattern, err))
     if ignore_case:
         patterns = [x.lower() for x in patterns]
-
     if len(set(patterns)) != len(patterns):
         exit("<pattern>s can't be equal")
-    elif len(patterns) == 1 and not ignore_case:
-        return find_single_pattern(patterns[0])
-    elif len(patterns) == 2 and replace:
+    if replace:
+        if len(patterns) != 2:
+            exit("with --replace you must specifcy 2 <pattern>s")
+        if not patterns[0]:
+            exit("with --replace the source <pattern> can't be empty")
         if ignore_case:
             exit("can't user --ignore-case with --replace")
-        return replace_patterns(patterns)
+
+
+def format_replace_diff(filepath, buf, src, dst, encoding=ENCODING):
+    """Return the unified diff (with no context lines) of replacing
+    'src' with 'dst' in a file, as a list of lines.
+    """
+    lines = [hilite("--- %s" % filepath, ok=None, bold=True),
+             hilite("+++ %s" % filepath, ok=None, bold=True)]
+    for old_start, old_lines, new_start, new_lines in \
+            iter_replace_hunks(buf, src, dst):
+        lines.append(hilite("@@ -%s,%s +%s,%s @@" % (
+            old_start, len(old_lines), new_start, len(new_lines)), ok=None))
+        for line in old_lines:
+            lines.append(hilite("-" + decode(line, encoding).rstrip('\r'),
+                                ok=False))
+        for line in new_lines:
+            lines.append(hilite("+" + decode(line, encoding).rstrip('\r')))
+    return lines
+
+
+def count_occurrences(buf, src):
+    occurrences = 0
+    pos = buf.find(src)
+    while pos != -1:
+        occurrences += 1
+        pos = buf.find(src, pos + len(src))
+    return occurrences
+
+
+def replace_file(filepath, src, dst, dry_run=False):
+    """Replace 'src' with 'dst' (both UTF-8 bytes) in a file and return
+    a (occurrences, output) tuple, where 'output' is the text to print.
+    With 'dry_run' the file is left alone and 'output' is a diff.
+    Binary files are skipped; other text files are written back in
+    their own encoding.
+    """
+    with open(filepath, 'rb') as f:
+        encoding = sniff_file(f)
+        if encoding is None:
+            return 0, ''
+        if encoding in ('utf-16', 'utf-32'):
+            # Not ASCII compatible: lines can't be split on b'\n'.
+            if decode(src) in decode(f.read(), encoding):
+                warn("skipping %s: can't replace in %s files" % (
+                    filepath, encoding))
+            return 0, ''
+        if encoding != ENCODING:
+            try:
+                src = src.decode(ENCODING).encode(encoding)
+                dst = dst.decode(ENCODING).encode(encoding)
+            except UnicodeEncodeError:
+                return 0, ''
+        with map_file(f) as buf:
+            # Cheap prefilter: most files won't contain 'src' at all
+            # and are not even read entirely.
+            if buf.find(src) == -1:
+                return 0, ''
+            if dry_run:
+                lines = format_replace_diff(filepath, buf, src, dst,
+                                            encoding)
+                return count_occurrences(buf, src), '\n'.join(lines) + '\n'
+            occurrences = replace_in_file(filepath, buf, src, dst)
+    return occurrences, "%s (%s occurrences)\n" % (
+        hilite(filepath, bold=True), hilite(occurrences))
+
+
+# --- search
+
+
+class Match(object):
+    """A line found by iter_matches(). 'line' is the raw bytes of the
+    line (decoded on demand by the 'text' property), 'offset' is its
+    byte offset in the (decompressed) file and 'spans' is the list
+    of (start, end) byte offsets of the matched text in 'line'.
+    Context lines (see 'nlines') have 'spans' set to None.
+    Text files which are not UTF-8 are searched after being converted
+    to UTF-8, and 'line' and 'offset' refer to the converted text.
+    """
+
+    __slots__ = ('path', 'lineno', 'offset', 'line', 'spans')
+
+    def __init__(self, path, lineno, offset, line, spans):
+        self.path = path
+        self.lineno = lineno
+        self.offset = offset
+        self.line = line
+        self.spans = spans
+
+    def __reduce__(self):
+        return (Match, (self.path, self.lineno, self.offset, self.line,
+                        self.spans))
+
+    def __repr__(self):
+        return "Match(path=%r, lineno=%r, offset=%r, spans=%r)" % (
+            self.path, self.lineno, self.offset, self.spans)
+
+    @property
+    def text(self):
+        return decode(self.line)
+
+    @property
+    def text_spans(self):
+        """The 'spans' as (start, end) character offsets in 'text'."""
+        if self.spans is None:
+            return None
+        return [(len(decode(self.line[:x])), len(decode(self.line[:y])))
+                for x, y in self.spans]
+
+    @property
+    def is_context(self):
+        return self.spans is None
+
+
+@contextlib.contextmanager
+def open_search(filepath, decompress=False):
+    """Open a file for searching it and return a (buf, blocks) tuple.
+    'buf' is a memory-mapped buffer, or None if the file is
+    compressed (and 'decompress' is True), in which case 'blocks'
+    iterates over its decompressed content (see iter_blocks()).
+    Both are None for binary files, which are recognized by reading
+    their first SNIFF_SIZE bytes only. Text which is not UTF-8 is
+    transcoded to UTF-8 in memory.
+    """
+    with open(filepath, 'rb') as f:
+        if decompress:
+            opener = get_decompressor(f.read(MAGIC_SIZE))
+            f.seek(0)
+            if opener is not None:
+                with contextlib.closing(opener(filepath, 'rb')) as zf:
+                    blocks = iter_blocks(zf, CHUNK_SIZE)
+                    head = next(blocks, b'')
+                    encoding = sniff(head[:SNIFF_SIZE])
+                    if encoding is None:
+                        yield None, None
+                        return
+                    blocks = itertools.chain([head], blocks)
+                    if encoding != ENCODING:
+                        blocks = (transcode(x, encoding) for x in blocks)
+                    yield None, blocks
+                return
+        encoding = sniff_file(f)
+        if encoding is None:
+            yield None, None
+        elif encoding != ENCODING:
+            yield transcode(f.read(), encoding), None
+        else:
+            with map_file(f) as buf:
+                yield buf, None
+
+
+def iter_buffer_matches(buf, matcher, nlines=0, max_count=0):
+    """Return an iterator of (lineno, offset, line, spans) tuples for
+    the lines of 'buf' matching 'matcher', plus the 'nlines' lines
+    around them.
+    """
+    if nlines:
+        if matcher.search(buf, 0) == -1:
+            return iter(())
+        return iter_context(iter_lines(buf), matcher, nlines,
+                            max_count=max_count)
+    results = iter_matching_lines(buf, matcher)
+    if max_count:
+        results = itertools.islice(results, max_count)
+    return results
+
+
+def search_file(filepath, matcher, nlines=0, max_count=0,
+                decompress=False):
+    """Search a file and yield a Match for every line matching
+    'matcher', plus the 'nlines' lines around them.
+    """
+    try:
+        with open_search(filepath, decompress) as (buf, blocks):
+            if buf is None and blocks is None:
+                return  # binary
+            if buf is not None:
+                results = iter_buffer_matches(buf, matcher, nlines=nlines,
+                                              max_count=max_count)
+            else:
+                if nlines:
+                    lines = (line for block in blocks
+                             for line in iter_lines(block))
+                    results = iter_context(lines, matcher, nlines,
+                                           max_count=max_count)
+                else:
+                    results = iter_matching_blocks(blocks, matcher)
+                    if max_count:
+                        results = itertools.islice(results, max_count)
+            for lineno, offset, line, spans in results:
+                yield Match(filepath, lineno, offset, line, spans)
+    except DECOMPRESSION_ERRORS as err:
+        warn("can't read %s: %s" % (filepath, err))
+
+
+def count_file(filepath, matcher, max_count=0, decompress=False):
+    """Return the number of lines of a file matching 'matcher',
+    stopping at 'max_count'. Line numbers and spans are not computed.
+    """
+    try:
+        with open_search(filepath, decompress) as (buf, blocks):
+            if buf is not None:
+                return count_matching_lines(buf, matcher, max_count)
+            if blocks is None:
+                return 0  # binary
+            return count_matching_blocks(blocks, matcher, max_count)
+    except DECOMPRESSION_ERRORS as err:
+        warn("can't read %s: %s" % (filepath, err))
+        return 0
+
+
+def iter_files(exts=None, root='.', threads=1, decompress=False):
+    """Walk 'root' and yield an os.DirEntry for every file which is
+    supposed to be searched, that is having one of the 'exts'
+    extensions (all files if None). IGNORE_ROOT_DIRS and .gitignore'd
+    dirs are not even descended into.
+    With 'decompress' compressed files are matched against 'exts'
+    by their inner extension (e.g. "foo.log.gz" -> ".log"), and
+    rotated files by the extension before the rotation suffix (e.g.
+    "foo.log.1.gz" and "foo.log-20160101" -> ".log").
+    """
+    ignore = ['/%s/' % x for x in IGNORE_ROOT_DIRS]
+    for entry in walk_files(root, ignore=ignore, threads=threads):
+        if has_ext(entry.name, exts, decompress):
+            yield entry
+
+
+def unique_files(files):
+    """Filter out the os.DirEntry in 'files' which are the same file
+    as a previous one, e.g. a symlink and its target.
+    """
+    seen = set()
+    for entry in files:
+        try:
+            st = entry.stat()
+        except OSError:
+            yield entry  # let the caller deal with it
+            continue
+        key = (st.st_dev, st.st_ino)
+        if key not in seen:
+            seen.add(key)
+            yield entry
+
+
+def has_ext(name, exts, decompress=False):
+    """Return True if a file name has one of the 'exts' extensions
+    (see iter_files()).
+    """
+    if exts is None or exts == set(['.*']) or name in SPECIAL_NAMES:
+        return True
+    base, ext = os.path.splitext(name)
+    if decompress:
+        if ext in COMPRESSED_EXTS:
+            name = base
+        ext = os.path.splitext(ROTATION_SUFFIX_RE.sub('', name))[1]
+    return ext in exts
+
+
+# --- parallel search
+
+
+def map_files(fun, files, jobs=1, threads=1):
+    """Call fun(filepath) for every os.DirEntry in 'files' and yield
+    (filepath, result) tuples in the same order, using 'jobs' worker
+    processes (see sysconf.parallel_map()). If there are less than
+    PARALLEL_MIN_FILES files the pool is not even started.
+    'threads' is the number of threads 'files' is walked with (see
+    walk_files()): forking while they run is not safe, so in that
+    case the walk is completed before the pool is started. Otherwise
+    the pool is started as soon as PARALLEL_MIN_FILES files are found
+    and the rest of the walk overlaps with the search.
+    """
+    files = (x.path for x in files)
+    if jobs != 1 and threads > 1:
+        files = list(files)
+        ret = parallel_map(fun, files, jobs=jobs,
+                           chunksize=PARALLEL_CHUNKSIZE,
+                           min_items=PARALLEL_MIN_FILES)
     else:
-        return find_multi_patterns(patterns)
+        head = list(itertools.islice(files, PARALLEL_MIN_FILES))
+        if len(head) < PARALLEL_MIN_FILES:
+            jobs = 1
+        ret = parallel_map(fun, itertools.chain(head, files), jobs=jobs,
+                           chunksize=PARALLEL_CHUNKSIZE)
+    for item in ret:
+        yield item
+
+
+def _search_path(patterns, ignore_case, regex, nlines, max_count,
+                 decompress, filepath):
+    matcher = get_matcher(patterns, ignore_case, regex)
+    return search_file(filepath, matcher, nlines=nlines,
+                       max_count=max_count, decompress=decompress)
+
+
+def _count_path(patterns, ignore_case, regex, max_count, decompress,
+                filepath):
+    matcher = get_matcher(patterns, ignore_case, regex)
+    return count_file(filepath, matcher, max_count=max_count,
+                      decompress=decompress)
+
+
+def _iter_candidates(patterns, root, exts, ignore_case, regex, decompress,
+                     threads, index):
+    files = iter_files(exts, root=root, decompress=decompress,
+                       threads=threads)
+    if index:
+        matcher = get_matcher(patterns, ignore_case, regex)
+        files = index_filter(files, matcher.literals, exts, root=root,
+                             ignore_case=matcher.ignore_case)
+    return files
+
+
+def iter_matches(patterns, root='.', exts=None, ignore_case=False,
+                 regex=False, nlines=0, max_count=0, decompress=False,
+                 jobs=1, threads=1, index=False):
+    """Search all files under 'root' having one of the 'exts'
+    extensions (e.g. set(['.py']), None for all files) and yield a
+    Match for every line containing all 'patterns', in walk order.
+    'nlines' context lines around the matches are yielded as well.
+    Other arguments match the CLI options; 'jobs' is the number of
+    worker processes (0 = number of CPUs) and 'threads' the number of
+    threads listing directories.
+    """
+    patterns = tuple(patterns)
+    files = _iter_candidates(patterns, root, exts, ignore_case, regex,
+                             decompress, threads, index)
+    fun = functools.partial(_search_path, patterns, ignore_case, regex,
+                            nlines, max_count, decompress)
+    for filepath, matches in map_files(fun, files, jobs=jobs,
+                                       threads=threads):
+        for match in matches:
+            yield match
+
+
+def iter_counts(patterns, root='.', exts=None, ignore_case=False,
+                regex=False, max_count=0, decompress=False, jobs=1,
+                threads=1, index=False):
+    """Like iter_matches() but yield a (filepath, count) tuple for
+    every file containing at least a matching line.
+    """
+    patterns = tuple(patterns)
+    files = _iter_candidates(patterns, root, exts, ignore_case, regex,
+                             decompress, threads, index)
+    fun = functools.partial(_count_path, patterns, ignore_case, regex,
+                            max_count, decompress)
+    for filepath, count in map_files(fun, files, jobs=jobs,
+                                     threads=threads):
+        if count:
+            yield filepath, count
+
+
+def iter_replace(src, dst, root='.', exts=None, dry_run=False, jobs=1,
+                 threads=1):
+    """Replace 'src' with 'dst' in all files under 'root' and yield a
+    (filepath, occurrences, output) tuple for every modified file.
+    Symlinks are replaced through (see replace_in_file()), so a file
+    reachable by more than one path is only processed the first time.
+    """
+    fun = functools.partial(replace_file, src=src.encode(ENCODING),
+                            dst=dst.encode(ENCODING), dry_run=dry_run)
+    files = unique_files(iter_files(exts, root=root, threads=threads))
+    for filepath, (occurrences, output) in map_files(
+            fun, files, jobs=jobs, threads=threads):
+        if occurrences:
+            yield filepath, occurrences, output
+
+
+# --- output
+
+
+def get_output():
+    """Return a buffered text stream writing to stdout, so that the
+    output isn't flushed on every line as print() would do on a
+    terminal.
+    """
+    sys.stdout.flush()
+    if not PY3:
+        return sys.stdout
+    return io.open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE,
+                   encoding=ENCODING, errors='replace', closefd=False)
+
+
+def write_matches(out, matches, fmt='text', context=False):
+    """Write an iterable of Match to 'out' in the given format
+    ('text', 'json' or 'null') and yield a (filepath, occurrences)
+    tuple after each file.
+    """
+    flush = out.isatty()
+    for filepath, group in itertools.groupby(
+            matches, key=operator.attrgetter('path')):
+        occurrences = 0
+        if fmt == 'text':
+            out.write(hilite(filepath, bold=True) + '\n')
+        last = None
+        for match in group:
+            if not match.is_context:
+                occurrences += 1
+            if fmt == 'json':
+                out.write(json.dumps(dict(
+                    path=filepath, lineno=match.lineno, offset=match.offset,
+                    line=match.text, context=match.is_context,
+                    spans=match.text_spans, byte_spans=match.spans)) + '\n')
+            elif fmt == 'null':
+                # like "grep -Z": file names end with a NUL byte
+                out.write("%s\0%s%s%s\n" % (
+                    filepath, match.lineno, '-' if match.is_context else ':',
+                    match.text.rstrip()))
+            else:
+                if context and last is not None and match.lineno > last + 1:
+                    out.write("." * TERMINAL_SIZE + '\n')
+                last = match.lineno
+                if match.is_context:
+                    text = match.text
+                else:
+                    text = hilite_spans(match.line, match.spans)
+                out.write("%s: %s\n" % (
+                    hilite(match.lineno, ok=None, bold=True), text.rstrip()))
+        if fmt == 'text':
+            out.write('\n')
+        if flush:
+            out.flush()
+        yield filepath, occurrences
+
+
+def write_counts(out, counts, fmt='text', files_only=False):
+    """Write the (filepath, count) tuples produced by iter_counts()
+    and yield them back.
+    """
+    flush = out.isatty()
+    for filepath, count in counts:
+        if fmt == 'json':
+            data = dict(path=filepath)
+            if not files_only:
+                data['count'] = count
+            out.write(json.dumps(data) + '\n')
+        elif fmt == 'null':
+            if files_only:
+                out.write(filepath + '\0')
+            else:
+                out.write("%s\0%s\n" % (filepath, count))
+        else:
+            if files_only:
+                out.write(filepath + '\n')
+            else:
+                out.write("%s:%s\n" % (filepath, count))
+        if flush:
+            out.flush()
+        yield filepath, count
+
+
+# --- trigram index
+
+
+def get_trigrams(data):
+    """Return the set of (lowercase) 3-bytes sequences in 'data'."""
+    data = data.lower()
+    trigrams = set()
+    for offset in range(3):
+        trigrams.update(TRIGRAM_RE.findall(data, offset))
+    return trigrams
+
+
+def get_pattern_trigrams(pattern, ignore_case=False):
+    """Return the trigrams a file must contain in order to match
+    'pattern'. With 'ignore_case' trigrams including non-ASCII bytes
+    are left out as bytes.lower() doesn't fold them.
+    """
+    trigrams = get_trigrams(pattern.encode(ENCODING))
+    if ignore_case:
+        trigrams = set(x for x in trigrams
+                       if all(c < 128 for c in bytearray(x)))
+    return trigrams
+
+
+def get_index_path(root='.'):
+    return get_state_path('grep.py', root, '.index')
+
+
+class TrigramIndex(object):
+    """A persistent trigram -> file ids map used to narrow down the
+    files which can possibly match a query. It's refreshed
+    incrementally: only the files whose mtime or size changed since
+    the last run are read again. Stale ids are not removed from the
+    posting lists on update but just forgotten, and the index is
+    compacted once they outnumber the live ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # filepath -> (id, mtime, size, indexed)
+        self.postings = {}  # trigram -> set of ids
+        self.next_id = 0
+        self.changed = False
+
+    def load(self):
+        state = load_state(self.path, INDEX_VERSION)
+        if state is not None:
+            self.files, self.postings, self.next_id = state
+
+    def save(self):
+        if not self.changed:
+            return
+        state = (self.files, self.postings, self.next_id)
+        save_state(self.path, INDEX_VERSION, state)
+        self.changed = False
+
+    def add(self, filepath, mtime, size):
+        fileid = self.next_id
+        self.next_id += 1
+        # Files which are not indexed are always a candidate.
+        self.files[filepath] = (fileid, mtime, size, False)
+        self.changed = True
+        if size > INDEX_MAX_FILE_SIZE:
+            return
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            return
+        if get_decompressor(data[:MAGIC_SIZE]) is not None:
+            return
+        self.files[filepath] = (fileid, mtime, size, True)
+        encoding = sniff(data[:SNIFF_SIZE])
+        if encoding is None:
+            return  # binary files are never a candidate
+        if encoding != ENCODING:
+            data = transcode(data, encoding)
+        postings = self.postings
+        for trigram in get_trigrams(data):
+            try:
+                postings[trigram].add(fileid)
+            except KeyError:
+                postings[trigram] = set([fileid])
+
+    def refresh(self, files, exts):
+        """Update the index against the list of os.DirEntry
+        instances currently found on disk.
+        """
+        seen = set()
+        for dirent in files:
+            filepath = dirent.path
+            seen.add(filepath)
+            try:
+                st = dirent.stat()
+            except EnvironmentError:
+                continue
+            entry = self.files.get(filepath)
+            if entry is None or entry[1:3] != (st.st_mtime, st.st_size):
+                self.add(filepath, st.st_mtime, st.st_size)
+        # Forget files which have been deleted. Files not matching
+        # the current extensions were simply not walked.
+        star_ext = exts is None or exts == set(['.*'])
+        for filepath in list(self.files):
+            if filepath not in seen:
+                if star_ext or os.path.splitext(filepath)[1] in exts or \
+                        not os.path.exists(filepath):
+                    del self.files[filepath]
+                    self.changed = True
+        if self.next_id > len(self.files) * 2 + 1000:
+            self.compact()
+
+    def compact(self):
+        remap = {}
+        for filepath, (fileid, mtime, size, indexed) in self.files.items():
+            remap[fileid] = len(remap)
+            self.files[filepath] = (remap[fileid], mtime, size, indexed)
+        postings = {}
+        for trigram, ids in self.postings.items():
+            ids = set(remap[x] for x in ids if x in remap)
+            if ids:
+                postings[trigram] = ids
+        self.postings = postings
+        self.next_id = len(remap)
+        self.changed = True
+
+    def get_candidates(self, patterns, ignore_case=False):
+        """Return the set of file paths which may contain all
+        'patterns', or None if the index can't tell (all patterns
+        are shorter than 3 chars).
+        """
+        trigrams = set()
+        for pattern in patterns:
+            trigrams.update(get_pattern_trigrams(pattern, ignore_case))
+        if not trigrams:
+            return None
+        ids = None
+        for trigram in sorted(trigrams,
+                              key=lambda x: len(self.postings.get(x, ()))):
+            ids = self.postings.get(trigram, set()) if ids is None else \
+                ids & self.postings.get(trigram, set())
+            if not ids:
+                break
+        return set(filepath for filepath, (fileid, _, _, indexed)
+                   in self.files.items()
+                   if fileid in ids or not indexed)
+
+
+def index_filter(files, patterns, exts, root='.', ignore_case=False):
+    """Filter a list of os.DirEntry instances through the trigram
+    index of 'root', refreshing it first.
+    """
+    files = list(files)
+    index = TrigramIndex(get_index_path(root))
+    index.load()
+    index.refresh(files, exts)
+    try:
+        index.save()
+    except EnvironmentError as err:
+        warn("can't save index: %s" % err)
+    candidates = index.get_candidates(patterns, ignore_case=ignore_case)
+    if candidates is None:
+        return files
+    return [x for x in files if x.path in candidates]
+
+
+# --- server
+
+
+class Inotify(object):
+    """A minimal ctypes wrapper around Linux inotify(7), watching
+    directories for changes to the files they contain.
+    """
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_TREE_CHANGED |
+            IN_ONLYDIR)
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(
+            os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd == -1:
+            self._raise()
+        self.dirs = {}  # dirpath -> watch descriptor
+        self.wds = {}  # watch descriptor -> dirpath
+
+    def _raise(self):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, dirpath):
+        if dirpath in self.dirs:
+            return
+        path = dirpath
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd == -1:
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR,
+                                      errno.EACCES):
+                return  # gone in the meantime
+            self._raise()  # e.g. ENOSPC, too many watches
+        self.dirs[dirpath] = wd
+        self.wds[wd] = dirpath
+
+    def unwatch(self, dirpath):
+        wd = self.dirs.pop(dirpath, None)
+        if wd is not None:
+            del self.wds[wd]
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Return the list of pending (dirpath, name, mask) events
+        without blocking. 'dirpath' is None if the kernel queue
+        overflowed and some events were lost.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+                pos += 16
+                name = data[pos:pos + size].rstrip(b'\0')
+                pos += size
+                dirpath = self.wds.get(wd)
+                if mask & IN_IGNORED and dirpath is not None:
+                    # the directory is gone and so is the watch
+                    del self.wds[wd]
+                    del self.dirs[dirpath]
+                if PY3:
+                    name = os.fsdecode(name)
+                events.append((dirpath, name, mask))
+
+
+class TreeCache(object):
+    """The list of files under 'root' plus an LRU cache of their
+    content, up to 'max_bytes', used by the --serve daemon.
+    With inotify the list is kept current cheaply: a modified file
+    just drops its cached content, while creations, deletions and
+    renames cause a new walk of the tree (which doesn't read the
+    files). Without it the tree is walked and stat()ed again before
+    a query if the last walk is older than POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, root='.', max_bytes=SERVER_MAX_MEMORY,
+                 inotify=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.inotify = inotify
+        self.files = collections.OrderedDict()  # path -> (mtime, size)
+        # path -> (mtime, size, data), least recently used first; 'data'
+        # is already transcoded to UTF-8, empty for binary files and None
+        # for compressed ones
+        self.contents = collections.OrderedDict()
+        self.nbytes = 0
+        self.last_scan = None  # None = the file list is stale
+
+    def scan(self):
+        dirs = set()
+
+        def ondir(dirpath):
+            dirs.add(dirpath)
+            if self.inotify is None:
+                return
+            # Watching a directory before listing it means no change
+            # can get lost in between.
+            try:
+                self.inotify.watch(dirpath)
+            except OSError as err:
+                warn("inotify: %s; falling back to polling" % err)
+                self.inotify.close()
+                self.inotify = None
+
+        files = collections.OrderedDict()
+        ignore = ['/%s/' % x for x in IGNORE_ROOT_DIRS]
+        for entry in walk_files(self.root, ignore=ignore, ondir=ondir):
+            try:
+                st = entry.stat()
+            except EnvironmentError:
+                continue
+            files[entry.path] = (st.st_mtime, st.st_size)
+        if self.inotify is not None:
+            for dirpath in set(self.inotify.dirs) - dirs:
+                self.inotify.unwatch(dirpath)
+        for filepath, (mtime, size, data) in list(self.contents.items()):
+            if files.get(filepath) != (mtime, size):
+                self.discard(filepath)
+        self.files = files
+        self.last_scan = time.time()
+
+    def update(self):
+        """Bring the file list up to date (before a query)."""
+        if self.inotify is not None:
+            for dirpath, name, mask in self.inotify.read():
+                if dirpath is None:  # IN_Q_OVERFLOW
+                    self.last_scan = None
+                    continue
+                if mask & IN_TREE_CHANGED or name == '.gitignore':
+                    self.last_scan = None
+                self.discard(os.path.join(dirpath, name))
+        if self.last_scan is None or (
+                self.inotify is None and
+                time.time() - self.last_scan > POLL_INTERVAL):
+            self.scan()
+
+    def discard(self, filepath):
+        entry = self.contents.pop(filepath, None)
+        if entry is not None and entry[2] is not None:
+            self.nbytes -= len(entry[2])
+
+    def read(self, filepath):
+        """Return the searchable content of a file from the cache,
+        reading it if needed, or None if it must be searched on disk
+        (it's compressed or too big to be cached).
+        """
+        entry = self.contents.pop(filepath, None)
+        if entry is None:
+            with open(filepath, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_size > self.max_bytes:
+                    return None
+                data = f.read()
+            if get_decompressor(data[:MAGIC_SIZE]) is not None:
+                data = None
+            else:
+                encoding = sniff(data[:SNIFF_SIZE])
+                if encoding is None:
+                    data = b''  # binary
+                elif encoding != ENCODING:
+                    data = transcode(data, encoding)
+                if len(data) > self.max_bytes:
+                    # grown after fstat() or by transcoding
+                    return None
+                self.nbytes += len(data)
+            entry = (st.st_mtime, st.st_size, data)
+            while self.nbytes > self.max_bytes and self.contents:
+                self.discard(next(iter(self.contents)))
+        self.contents[filepath] = entry  # most recently used
+        return entry[2]
+
+    def iter_files(self, exts=None, decompress=False):
+        for filepath in self.files:
+            if has_ext(os.path.basename(filepath), exts, decompress):
+                yield filepath
+
+    def search(self, filepath, matcher, nlines=0, max_count=0,
+               decompress=False):
+        """Like search_file() but reading from the cache."""
+        try:
+            data = self.read(filepath)
+        except EnvironmentError:
+            return ()  # deleted in the meantime
+        if data is None:
+            return search_file(filepath, matcher, nlines=nlines,
+                               max_count=max_count, decompress=decompress)
+        return (Match(filepath, *x) for x in iter_buffer_matches(
+            data, matcher, nlines=nlines, max_count=max_count))
+
+    def count(self, filepath, matcher, max_count=0, decompress=False):
+        """Like count_file() but reading from the cache."""
+        try:
+            data = self.read(filepath)
+        except EnvironmentError:
+            return 0
+        if data is None:
+            return count_file(filepath, matcher, max_count=max_count,
+                              decompress=decompress)
+        return count_matching_lines(data, matcher, max_count=max_count)
+
+
+def get_socket_path(root='.'):
+    return get_state_path('grep.py', root, '.sock')
+
+
+def _dump_match(match):
+    # 'line' is raw bytes: latin-1 maps them 1:1 to code points.
+    return [match.path, match.lineno, match.offset,
+            match.line.decode('latin-1'), match.spans]
+
+
+def _load_match(obj):
+    path, lineno, offset, line, spans = obj
+    if spans is not None:
+        spans = [tuple(x) for x in spans]
+    return Match(path, lineno, offset, line.encode('latin-1'), spans)
+
+
+def _handle_query(cache, request, f):
+    # A request is a JSON line with the iter_matches() arguments plus
+    # 'count'. Responses are JSON lines too (never pickles, as the
+    # client can't trust whoever owns the socket): [kind, payload]
+    # where kind is 'matches' (a list of _dump_match() for every
+    # matching file), 'count' ([filepath, count]) or 'error' (msg).
+    def send(kind, payload):
+        f.write(json.dumps([kind, payload]).encode(ENCODING) + b'\n')
+
+    try:
+        patterns = tuple(request['patterns'])
+        exts = set(request['exts']) if request['exts'] is not None else None
+        decompress = request['decompress']
+        nlines = request['nlines']
+        max_count = request['max_count']
+        count_only = request['count']
+        matcher = get_matcher(patterns, request['ignore_case'],
+                              request['regex'])
+    except (KeyError, TypeError, ValueError, re.error) as err:
+        send('error', "invalid request: %s" % err)
+        return
+    cache.update()
+    for filepath in cache.iter_files(exts, decompress):
+        try:
+            if count_only:
+                count = cache.count(filepath, matcher, max_count=max_count,
+                                    decompress=decompress)
+                if count:
+                    send('count', (filepath, count))
+            else:
+                matches = list(cache.search(
+                    filepath, matcher, nlines=nlines,
+                    max_count=max_count, decompress=decompress))
+                if matches:
+                    send('matches', [_dump_match(x) for x in matches])
+        except (socket.error, IOError):
+            raise  # the client went away
+        except Exception as err:
+            send('error', "%s: %r" % (filepath, err))
+            raise
+
+
+def serve(root='.', max_bytes=SERVER_MAX_MEMORY):
+    """Run a daemon which keeps the files under 'root' in memory and
+    answers the queries of iter_remote() over a Unix socket, one at
+    a time, until interrupted.
+    """
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError, TypeError) as err:
+        # not Linux or no libc
+        warn("inotify not available (%s); falling back to polling" % err)
+        inotify = None
+    cache = TreeCache(root, max_bytes=max_bytes, inotify=inotify)
+    cache.scan()
+
+    path = get_socket_path(root)
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            os.remove(path)  # stale
+        else:
+            exit("a server is already listening on %s" % path)
+        finally:
+            sock.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may connect.
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print("serving %s files on %s (%s)" % (
+        hilite(len(cache.files), bold=True), path,
+        "inotify" if cache.inotify is not None else "polling"))
+    try:
+        while True:
+            fds = [sock]
+            if cache.inotify is not None:
+                fds.append(cache.inotify)
+            readable = select.select(fds, [], [])[0]
+            if sock not in readable:
+                cache.update()  # inotify events only
+                continue
+            conn = sock.accept()[0]
+            try:
+                with contextlib.closing(conn.makefile('rb')) as fin:
+                    with contextlib.closing(conn.makefile('wb')) as fout:
+                        request = json.loads(fin.readline().decode(ENCODING))
+                        _handle_query(cache, request, fout)
+            except (socket.error, IOError, ValueError) as err:
+                # e.g. the client went away ("grep.py --client | head")
+                if getattr(err, 'errno', None) != errno.EPIPE:
+                    warn("query failed: %s" % err)
+            except Exception as err:
+                # a bug: don't let a single query kill the daemon
+                warn("query failed: %r" % err)
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        os.remove(path)
+
+
+def connect_server(root='.'):
+    """Return a socket connected to the --serve daemon of 'root'."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path(root))
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def iter_remote(sock, patterns, exts=None, ignore_case=False, regex=False,
+                nlines=0, max_count=0, decompress=False, count=False):
+    """Run a query on the --serve daemon connected to 'sock' and yield
+    what iter_matches() (or iter_counts() if 'count' is True) would.
+    """
+    request = dict(patterns=list(patterns), ignore_case=ignore_case,
+                   regex=regex, nlines=nlines, max_count=max_count,
+                   decompress=decompress, count=count,
+                   exts=sorted(exts) if exts is not None else None)
+    with contextlib.closing(sock):
+        sock.sendall(json.dumps(request).encode(ENCODING) + b'\n')
+        with contextlib.closing(sock.makefile('rb')) as f:
+            for line in f:
+                kind, payload = json.loads(line.decode(ENCODING))
+                if kind == 'error':
+                    raise ValueError(payload)
+                elif kind == 'matches':
+                    for obj in payload:
+                        yield _load_match(obj)
+                else:
+                    yield tuple(payload)
 
 
 def main(argv=None):
     # CLI parsing.
     args = docopt(__doc__, argv=argv)
+    if args['--serve']:
+        if args['--max-memory']:
+            max_bytes = int(args['--max-memory']) * 1024 * 1024
+        else:
+            max_bytes = SERVER_MAX_MEMORY
+        return serve(max_bytes=max_bytes)
     if args['--exts']:
         exts = args['--exts'].split(',')
     else:
@@ -368,46 +1950,98 @@ def main(argv=None):
     replace = args['--replace']
     ignore_case = args['--ignore-case']
     nlines = int(args['--nlines']) if args['--nlines'] else 0
-    start_ext = exts == set(['.*'])
+    jobs = int(args['--jobs']) if args['--jobs'] else 1
+    threads = int(args['--threads']) if args['--threads'] else 1
+    regex = args['--regex']
+    dry_run = args['--dry-run']
+    if dry_run and not replace:
+        exit("--dry-run can only be used with --replace")
+    files_only = args['--files-with-matches']
+    count_only = args['--count']
+    max_count = int(args['--max-count']) if args['--max-count'] else 0
+    if replace and (files_only or count_only or max_count):
+        exit("can't use -l, -c or -m with --replace")
+    check_patterns(patterns, replace=replace, ignore_case=ignore_case,
+                   regex=regex)
+
+    decompress = args['--decompress']
+    index = args['--index']
+    client = args['--client']
+    if client:
+        if replace or index:
+            exit("can't use --replace or --index with --client")
+        try:
+            sock = connect_server()
+        except socket.error as err:
+            exit("can't connect to the server (%s); start it with "
+                 "'grep.py --serve'" % err)
+    if args['--json']:
+        fmt = 'json'
+    elif args['--null']:
+        fmt = 'null'
+    else:
+        fmt = 'text'
 
     # Run.
     files_matching = []
     occurrences = 0
     exts_map = collections.defaultdict(int)
 
-    for root, dirs, files in os.walk('.', topdown=False):
-        parent_root = os.path.normpath(root).split('/')[0]
-        if parent_root in IGNORE_ROOT_DIRS and os.path.isdir(parent_root):
-            continue  # skip
-        if parent_root.endswith('.egg-info'):
-            continue  # skip
-        for name in files:
-            ext = os.path.splitext(name)[1]
-            if ext not in exts:
-                if name not in SPECIAL_NAMES:
-                    if not start_ext:
-                        continue   # skip
-            filepath = os.path.join(root, name)
-            ocs = grep_file(
-                filepath, patterns,
-                replace=replace, ignore_case=ignore_case, nlines=nlines)
-
-            occurrences += ocs
-            if ocs:
-                exts_map[ext] += 1
-                files_matching.append(filepath)
+    out = get_output()
+    if replace:
+        def iter_results():
+            for filepath, ocs, output in iter_replace(
+                    patterns[0], patterns[1], exts=exts, dry_run=dry_run,
+                    jobs=jobs, threads=threads):
+                out.write(output)
+                yield filepath, ocs
+        results = iter_results()
+    elif files_only or count_only:
+        if files_only:
+            max_count = 1
+        if client:
+            counts = iter_remote(
+                sock, patterns, exts=exts, ignore_case=ignore_case,
+                regex=regex, max_count=max_count, decompress=decompress,
+                count=True)
+        else:
+            counts = iter_counts(
+                patterns, exts=exts, ignore_case=ignore_case, regex=regex,
+                max_count=max_count, decompress=decompress, jobs=jobs,
+                threads=threads, index=index)
+        results = write_counts(out, counts, fmt=fmt, files_only=files_only)
+    else:
+        if client:
+            matches = iter_remote(
+                sock, patterns, exts=exts, ignore_case=ignore_case,
+                regex=regex, nlines=nlines, max_count=max_count,
+                decompress=decompress)
+        else:
+            matches = iter_matches(
+                patterns, exts=exts, ignore_case=ignore_case, regex=regex,
+                nlines=nlines, max_count=max_count, decompress=decompress,
+                jobs=jobs, threads=threads, index=index)
+        results = write_matches(out, matches, fmt=fmt, context=bool(nlines))
+    for filepath, ocs in results:
+        occurrences += ocs
+        exts_map[os.path.splitext(filepath)[1]] += 1
+        files_matching.append(filepath)
 
     if occurrences:
-        # Print final stats.
-        exts_stats = []
-        for k, v in sorted(exts_map.items(), key=lambda v: v[1], reverse=1):
-            exts_stats.append("%s=%s" % (k, hilite(v)))
+        # Print final stats (only in text mode, the others are meant
+        # for scripting).
+        if fmt == 'text' and not (files_only or count_only):
+            exts_stats = []
+            for k, v in sorted(exts_map.items(), key=lambda v: v[1],
+                               reverse=1):
+                exts_stats.append("%s=%s" % (k, hilite(v)))
 
-        print("occurrences=%s, files-matching=%s, exts=(%s)" % (
-            hilite(occurrences, bold=True),
-            hilite(len(files_matching), bold=True),
-            ','.join(exts_stats),
-        ))
+            out.write("occurrences=%s, files-matching=%s, exts=(%s)\n" % (
+                hilite(occurrences, bold=True),
+                hilite(len(files_matching), bold=True),
+                ','.join(exts_stats),
+            ))
+        out.flush()
 
         if args['--open']:
             if len(files_matching) == 1:
@@ -433,3 +2067,10 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         print()
         sys.exit(1)
+    except IOError as err:
+        # e.g. "grep.py -l foo | head"
+        if err.errno != errno.EPIPE:
+            raise
+        # Avoid another EPIPE when stdout is flushed on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -7,24 +7,64 @@
 Kill a process by name. Similar to 'killall' command, it just tries
 harder to kill the process by:
 - inspecting both name and cmdline
-- sending also SIGKILL is process survives SIGTERM
+- optionally selecting processes by user, age, memory, CPU usage or
+  listening port as well (or instead)
+- sending also SIGKILL is process survives SIGTERM (or any other
+  sequence of signals, see --signals)
+- optionally keeping on killing matching processes as they appear
+  (see --watch)
 
 Usage:
-    killall.py [-d] [-t] [-v] [-r] <name>
+    killall.py [-d] [-t <secs>] [-s <signals>] [-v] [-r] [-w] [-e]
+               [-u <user>] [--older=<secs>] [--younger=<secs>]
+               [--min-rss=<size>] [--min-cpu=<percent>] [--port=<port>]
+               [<name>]
 
 Options:
-    -d --dryrun     # just print processes matching <name> without killing them
-    -t --timeout    # how much to wait for proc to die
-    -v --verbose    # print more info about the process
-    -r --recursive  # also includes children
+    -d --dryrun                # just print processes matching <name>
+                               # without killing them
+    -t <secs> --timeout=<secs>
+                               # how much to wait for proc to die after
+                               # each signal; default=1
+    -s <signals> --signals=<signals>
+                               # comma-separated signals to send in
+                               # order, each one optionally followed by
+                               # ":<secs>" to override --timeout, e.g.
+                               # "SIGINT:2s,SIGTERM:5s,SIGKILL";
+                               # default=SIGTERM,SIGKILL
+    -v --verbose               # print more info about the process
+    -r --recursive             # also includes children
+    -w --watch                 # keep running and kill new matching
+                               # processes as soon as they appear,
+                               # until interrupted with CTRL+C
+    -e --regex                 # <name> is a regular expression
+    -u <user> --user=<user>    # only processes owned by <user>
+    --older=<secs>             # only processes started more than
+                               # <secs> ago (also "30m", "2h", "1d")
+    --younger=<secs>           # only processes started less than
+                               # <secs> ago
+    --min-rss=<size>           # only processes using more than <size>
+                               # resident memory (e.g. "500M", "4G")
+    --min-cpu=<percent>        # only processes using more than
+                               # <percent> CPU (measured over
+                               # CPU_INTERVAL secs)
+    --port=<port>              # only processes listening on TCP or UDP
+                               # <port>
 """
 
-from __future__ import print_function
+from __future__ import print_function, division
 
 import collections
+import errno
 import os
+import pwd
+import re
+import select
 import signal
+import socket
+import struct
 import sys
+import time
 import psutil
 
 from docopt import docopt
@@ -34,50 +74,388 @@ from sysconf import hilite
 
 THIS_PID = os.getpid()
 PY3 = sys.version_info[0] == 3
+LINUX = sys.platform.startswith('linux')
 TIMEOUT = 1
+SIGNALS = 'SIGTERM,SIGKILL'
+# how often to check the processes which can't be waited via a pidfd
+POLL_INTERVAL = 0.05
+# --watch: how often to look for new processes if the proc connector
+# isn't available
+WATCH_INTERVAL = 0.2
+# netlink proc connector, see <linux/connector.h> and <linux/cn_proc.h>
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+VALID_SIGNALS = set(
+    getattr(signal, x) for x in dir(signal)
+    if x.startswith('SIG') and not x.startswith('SIG_'))
+# the process attributes collected by snapshot()
+SNAPSHOT_ATTRS = ['pid', 'name', 'cmdline', 'ppid', 'status', 'username',
+                  'create_time']
+# --min-cpu: the interval CPU usage is measured over
+CPU_INTERVAL = 0.5
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30,
+              'T': 1 << 40}
+if LINUX:
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+    PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+# /proc/<pid>/stat state field -> psutil.STATUS_* constant
+PROC_STATUSES = {
+    b'R': 'running',
+    b'S': 'sleeping',
+    b'D': 'disk-sleep',
+    b'T': 'stopped',
+    b't': 'tracing-stop',
+    b'Z': 'zombie',
+    b'X': 'dead',
+    b'x': 'dead',
+    b'K': 'wake-kill',
+    b'W': 'waking',
+    b'P': 'parked',
+    b'I': 'idle',
+}
 ntproc = collections.namedtuple('Process', 'pid name status ppid parent')
+_usernames = {}
+_boot_time = []
 
 
 def logerr(s):
     print(hilite(s, ok=False))
 
 
-def str_proc(p):
+# ===================================================================
+# process snapshot
+# ===================================================================
+
+
+def fsdecode(s):
+    return os.fsdecode(s) if PY3 else s
+
+
+def get_username(uid):
+    try:
+        return _usernames[uid]
+    except KeyError:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            name = str(uid)
+        _usernames[uid] = name
+        return name
+
+
+def get_boot_time():
+    if not _boot_time:
+        _boot_time.append(psutil.boot_time())
+    return _boot_time[0]
+
+
+def read_proc(pid):
+    """Read the SNAPSHOT_ATTRS of a process straight from /proc (two
+    reads and a stat(), about what psutil does for name() alone).
+    The RSS comes for free with them, so it's included as well.
+    """
+    with open('/proc/%s/stat' % pid, 'rb') as f:
+        data = f.read()
+    with open('/proc/%s/cmdline' % pid, 'rb') as f:
+        cmdline = f.read()
+    uid = os.stat('/proc/%s' % pid).st_uid
+    rpar = data.rfind(b')')
+    name = data[data.find(b'(') + 1:rpar]
+    fields = data[rpar + 2:].split()
+    if cmdline.endswith(b'\0'):
+        cmdline = cmdline[:-1]
+    cmdline = [fsdecode(x) for x in cmdline.split(b'\0')] if cmdline else []
+    name = fsdecode(name)
+    if len(name) >= 15 and cmdline:
+        # the kernel truncates names to 15 chars; like psutil, use
+        # the full one from the cmdline if it matches
+        exename = os.path.basename(cmdline[0])
+        if exename.startswith(name):
+            name = exename
+    return dict(pid=pid, name=name, cmdline=cmdline, ppid=int(fields[1]),
+                status=PROC_STATUSES.get(fields[0], '?'),
+                username=get_username(uid),
+                create_time=get_boot_time() + int(fields[19]) / CLOCK_TICKS,
+                rss=int(fields[21]) * PAGESIZE)
+
+
+def get_rss(info):
+    """Return the RSS of a snapshot() process, fetching it on first
+    use if it's not there already; None if it can't be read.
+    """
+    if 'rss' not in info:
+        try:
+            info['rss'] = psutil.Process(info['pid']).memory_info().rss
+        except psutil.Error:
+            info['rss'] = None
+    return info['rss']
+
+
+def read_cpu_time(pid):
+    """Return the user + system CPU time of a process, or None if it
+    can't be read.
+    """
+    try:
+        if LINUX:
+            with open('/proc/%s/stat' % pid, 'rb') as f:
+                data = f.read()
+            fields = data[data.rfind(b')') + 2:].split()
+            return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        return sum(psutil.Process(pid).cpu_times()[:2])
+    except (IOError, OSError, IndexError, ValueError, psutil.Error):
+        return None
+
+
+def snapshot():
+    """Collect the SNAPSHOT_ATTRS of all processes in one pass and
+    return a {pid: info} dict. On Linux read /proc directly, else use
+    psutil.process_iter(attrs), which fetches them in oneshot() mode.
+    Attributes which can't be read because of permissions are None.
+    """
+    procs = {}
+    if LINUX and os.path.isdir('/proc/self'):
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                pid = int(entry)
+                try:
+                    procs[pid] = read_proc(pid)
+                except (IOError, OSError, IndexError, ValueError):
+                    # gone in the meantime
+                    pass
+        return procs
+    for p in psutil.process_iter(SNAPSHOT_ATTRS, ad_value=None):
+        procs[p.pid] = p.info
+    return procs
+
+
+def str_proc(info, procs):
+    """Represent a process 'info' dict, as returned by snapshot()."""
+    parent = procs.get(info['ppid'])
+    parname = parent['name'] if parent is not None else None
     if VERBOSE:
         import pprint
-        info = p.as_dict(
-            ['pid', 'ppid', 'name', 'cmdline', 'status', 'username'])
-        info['cmdline'] = ' '.join(info['cmdline'])
-        par = p.parent()
-        if par:
-            info['parent'] = par.name()
+        info = dict(info)
+        info['cmdline'] = ' '.join(info['cmdline'] or [])
+        if parname is not None:
+            info['parent'] = parname
         return "Process(%s)" % pprint.pformat(info)
     else:
-        par = p.parent()
-        parname = par.name() if par is not None else None
-        return str(ntproc(p.pid, p.name(), p.status(), p.ppid(), parname))
+        return str(ntproc(info['pid'], info['name'], info['status'],
+                          info['ppid'], parname))
 
 
-def find_procs(name, recursive=False):
-    procs = []
-    for p in psutil.process_iter():
-        if p.pid != THIS_PID:
-            try:
-                p_name = p.name()
-                p_cmdline = p.cmdline()
-            except psutil.NoSuchProcess:
-                pass
-            except psutil.AccessDenied:
-                logerr("access denied: %s" % p)
-            else:
-                if name in p_name or name in ' '.join(p_cmdline):
-                    p.strrepr = str_proc(p)
-                    procs.append(p)
-                    if recursive:
-                        for child in p.children():
-                            child.strrepr = str_proc(child)
-                            procs.append(child)
-    return procs
+# ===================================================================
+# implementation
+# ===================================================================
+
+
+def parse_duration(s):
+    """Parse "2", "1.5", "2s", "500ms", "30m", "2h" or "1d" into secs."""
+    m = re.match(r'^([\d.]+)\s*(ms|s|m|h|d)?$', s.strip())
+    try:
+        return float(m.group(1)) * DURATION_UNITS[m.group(2) or 's']
+    except (AttributeError, ValueError):
+        raise ValueError("invalid duration %r" % s)
+
+
+def parse_size(s):
+    """Parse "1024", "500K", "500M", "4G" or "4GB" into bytes."""
+    m = re.match(r'^([\d.]+)\s*([KMGT]?)B?$', s.strip().upper())
+    try:
+        return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+    except (AttributeError, ValueError):
+        raise ValueError("invalid size %r" % s)
+
+
+# --- filters
+#
+# A filter takes a list of snapshot() infos and returns the ones
+# which match. They are applied in order, so that the expensive ones
+# only see what survived the cheap ones.
+
+
+def filter_name(infos, name):
+    return [x for x in infos
+            if name in x['name'] or name in ' '.join(x['cmdline'])]
+
+
+def filter_regex(infos, regex):
+    return [x for x in infos
+            if regex.search(x['name']) or
+            regex.search(' '.join(x['cmdline']))]
+
+
+def filter_user(infos, user):
+    return [x for x in infos if x['username'] == user]
+
+
+def filter_age(infos, older=None, younger=None):
+    now = time.time()
+    ret = []
+    for info in infos:
+        if info['create_time'] is None:
+            continue
+        age = now - info['create_time']
+        if older is not None and age <= older:
+            continue
+        if younger is not None and age >= younger:
+            continue
+        ret.append(info)
+    return ret
+
+
+def filter_rss(infos, min_rss):
+    return [x for x in infos if (get_rss(x) or 0) > min_rss]
+
+
+def filter_cpu(infos, min_percent):
+    before = [(x, read_cpu_time(x['pid'])) for x in infos]
+    if not before:
+        return []
+    t = time.time()
+    time.sleep(CPU_INTERVAL)
+    ret = []
+    for info, cpu_time in before:
+        now = read_cpu_time(info['pid'])
+        if cpu_time is not None and now is not None:
+            percent = (now - cpu_time) / (time.time() - t) * 100
+            if percent > min_percent:
+                ret.append(info)
+    return ret
+
+
+def filter_port(infos, port):
+    if not infos:
+        return []
+    # a single system-wide call, instead of one per process
+    try:
+        conns = psutil.net_connections('inet')
+    except psutil.AccessDenied:
+        logerr("access denied: can't list connections")
+        return []
+    pids = set()
+    for conn in conns:
+        if conn.pid is None or not conn.laddr or conn.laddr[1] != port:
+            continue
+        if conn.status == psutil.CONN_LISTEN or \
+                (conn.type == socket.SOCK_DGRAM and not conn.raddr):
+            pids.add(conn.pid)
+    return [x for x in infos if x['pid'] in pids]
+
+
+def make_filters(name=None, regex=False, user=None, older=None,
+                 younger=None, min_rss=None, min_cpu=None, port=None):
+    """Return the list of filters (in evaluation order) selecting the
+    processes which satisfy all the given criteria.
+    """
+    filters = []
+    if name is not None:
+        if regex:
+            pattern = re.compile(name)
+            filters.append(lambda x: filter_regex(x, pattern))
+        else:
+            filters.append(lambda x: filter_name(x, name))
+    if user is not None:
+        filters.append(lambda x: filter_user(x, user))
+    if older is not None or younger is not None:
+        filters.append(lambda x: filter_age(x, older, younger))
+    if min_rss is not None:
+        filters.append(lambda x: filter_rss(x, min_rss))
+    if port is not None:
+        filters.append(lambda x: filter_port(x, port))
+    if min_cpu is not None:
+        filters.append(lambda x: filter_cpu(x, min_cpu))
+    return filters
+
+
+def make_proc(info, procs):
+    """Return a psutil.Process for a snapshot 'info' dict, or None if
+    it's gone in the meantime.
+    """
+    try:
+        p = psutil.Process(info['pid'])
+    except psutil.NoSuchProcess:
+        return None
+    p.strrepr = str_proc(info, procs)
+    return p
+
+
+def get_children_map(procs):
+    """Return a {ppid: [pid, ...]} dict from a snapshot()."""
+    children = collections.defaultdict(list)
+    for pid, info in procs.items():
+        if info['ppid'] != pid:
+            children[info['ppid']].append(pid)
+    return children
+
+
+def iter_tree(root, children, seen):
+    """Yield the pids of the process tree rooted in 'root', leaves
+    first (post-order), skipping the ones in 'seen' (which is updated).
+    """
+    stack = [(root, False)]
+    while stack:
+        pid, expanded = stack.pop()
+        if expanded:
+            yield pid
+        elif pid not in seen:
+            seen.add(pid)
+            stack.append((pid, True))
+            stack.extend((x, False) for x in children.get(pid, ()))
+
+
+def select_procs(procs, filters, recursive=False, pids=None):
+    """Return the psutil.Process instances passing all the 'filters'
+    (see make_filters()) out of a process table as returned by
+    snapshot(), only considering 'pids' if given. With 'recursive'
+    also include all their descendants, ordered so that children
+    come before their parents.
+    """
+    if pids is None:
+        pids = procs
+    infos = []
+    for pid in sorted(pids):
+        info = procs.get(pid)
+        if info is None or pid == THIS_PID:
+            continue
+        if info['name'] is None or info['cmdline'] is None:
+            logerr("access denied: %s" % str_proc(info, procs))
+            continue
+        infos.append(info)
+    for fun in filters:
+        infos = fun(infos)
+    children = get_children_map(procs) if recursive else {}
+    seen = set([THIS_PID])
+    found = []
+    for info in infos:
+        pid = info['pid']
+        if pid in seen:
+            continue
+        if recursive:
+            found.extend(iter_tree(pid, children, seen))
+        else:
+            seen.add(pid)
+            found.append(pid)
+    ret = []
+    for pid in found:
+        p = make_proc(procs[pid], procs)
+        if p is not None:
+            ret.append(p)
+    return ret
+
+
+def find_procs(filters, recursive=False):
+    """Return the processes passing all the 'filters' (see
+    select_procs()) out of one snapshot() of the process table.
+    """
+    return select_procs(snapshot(), filters, recursive=recursive)
 
 
 def stringify_sig(signum):
@@ -86,70 +464,341 @@ def stringify_sig(signum):
                      if x.startswith('SIG')])
         return smap.get(signum, signum)
     else:
-        return signum
+        return signal.Signals(signum).name
 
 
-def main():
-    global VERBOSE
+def parse_signals(s, timeout=TIMEOUT):
+    """Parse an escalation ladder such as "SIGINT:2s,SIGTERM:5s,SIGKILL"
+    into a list of (signum, timeout) tuples. Signals can be given by
+    name, with or without the "SIG" prefix, or by number.
+    """
+    ladder = []
+    for item in s.split(','):
+        name, _, secs = item.strip().partition(':')
+        if name.isdigit():
+            signum = int(name)
+        else:
+            name = name.upper()
+            if not name.startswith('SIG'):
+                name = 'SIG' + name
+            signum = getattr(signal, name, None)
+        if signum not in VALID_SIGNALS:
+            raise ValueError("invalid signal %r" % item)
+        ladder.append((signum, parse_duration(secs) if secs else timeout))
+    return ladder
+
 
-    def signal_proc(p, sig):
+def open_pidfd(pid):
+    """Return a file descriptor which becomes readable when the process
+    exits (Linux >= 5.3, Python >= 3.9) or None.
+    """
+    if not hasattr(os, 'pidfd_open') or not hasattr(select, 'poll'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def escalate(procs, ladder):
+    """Send the signals of the 'ladder' (as returned by parse_signals())
+    to 'procs' in order. Each process moves to the next stage on its
+    own, as soon as it outlives the timeout of the current one. Exits
+    are waited for via pidfds and poll(), falling back on checking
+    the processes every POLL_INTERVAL secs. Return the processes
+    still alive after the last stage.
+    """
+    stages = {}   # proc -> (stage, deadline)
+    pidfds = {}   # fd -> proc
+    nofds = set()
+    poller = select.poll() if hasattr(select, 'poll') else None
+    survivors = []
+
+    def forget(p):
+        del stages[p]
+        if p.pidfd is not None:
+            poller.unregister(p.pidfd)
+            del pidfds[p.pidfd]
+            os.close(p.pidfd)
+        else:
+            nofds.discard(p)
+
+    def next_stage(p, stage):
+        sig, timeout = ladder[stage]
         strsig = stringify_sig(sig)
         try:
             p.send_signal(sig)
         except psutil.NoSuchProcess:
-            pass
+            forget(p)
         except psutil.AccessDenied:
             logerr("%s access denied: %s" % (strsig, p))
+            forget(p)
         else:
             print("%s %s" % (strsig, p.strrepr))
-            signaled.append(p)
+            stages[p] = (stage, time.time() + timeout)
+
+    for p in procs:
+        p.pidfd = open_pidfd(p.pid)
+        if p.pidfd is not None:
+            poller.register(p.pidfd, select.POLLIN)
+            pidfds[p.pidfd] = p
+        else:
+            nofds.add(p)
+        stages[p] = (0, None)
+        next_stage(p, 0)
+
+    while stages:
+        # wait for the first exit or the first deadline
+        timeout = max(min(x[1] for x in stages.values()) - time.time(), 0)
+        if nofds:
+            timeout = min(timeout, POLL_INTERVAL)
+        gone = []
+        if pidfds:
+            gone.extend(pidfds[fd] for fd, _ in poller.poll(timeout * 1000))
+        elif timeout:
+            time.sleep(timeout)
+        if nofds:
+            gone.extend(psutil.wait_procs(list(nofds), timeout=0)[0])
+        for p in gone:
+            print(hilite("%s is gone" % p.strrepr))
+            forget(p)
+        # escalate the processes which outlived their stage
+        now = time.time()
+        for p, (stage, deadline) in list(stages.items()):
+            if deadline <= now:
+                if stage + 1 < len(ladder):
+                    next_stage(p, stage + 1)
+                else:
+                    survivors.append(p)
+                    forget(p)
+    return survivors
+
+
+# ===================================================================
+# watch mode
+# ===================================================================
+
+
+def read_info(pid):
+    """Return the SNAPSHOT_ATTRS of a single process as a dict, or None
+    if it's gone.
+    """
+    try:
+        if LINUX:
+            return read_proc(pid)
+        return psutil.Process(pid).as_dict(SNAPSHOT_ATTRS, ad_value=None)
+    except (IOError, OSError, IndexError, ValueError, psutil.NoSuchProcess):
+        return None
+
+
+def list_pids():
+    if LINUX:
+        return set(int(x) for x in os.listdir('/proc') if x.isdigit())
+    return set(psutil.pids())
+
+
+class ProcConnector(object):
+    """Receive fork, exec and exit events from the Linux proc connector
+    via a netlink socket. Subscribing requires CAP_NET_ADMIN and the
+    events are only delivered in the initial namespaces, so use
+    open_proc_connector(), which checks that they actually arrive.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((0, CN_IDX_PROC))
+            payload = struct.pack('=IIIIHHI', CN_IDX_PROC, CN_VAL_PROC,
+                                  0, 0, 4, 0, PROC_CN_MCAST_LISTEN)
+            header = struct.pack('=IHHII', 16 + len(payload), NLMSG_DONE,
+                                 0, 0, 0)
+            self.sock.send(header + payload)
+        except Exception:
+            self.sock.close()
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def read(self):
+        """Consume the pending events and return a (new, gone) tuple of
+        pid sets. New means forked or exec()ed. Raise socket.error
+        ENOBUFS if events were lost.
+        """
+        new = set()
+        gone = set()
+        while True:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return new, gone
+                raise
+            # nlmsghdr (16 bytes) + cn_msg (20) + proc_event header (16)
+            offset = 0
+            while offset + 52 <= len(data):
+                msglen = struct.unpack_from('=I', data, offset)[0]
+                what = struct.unpack_from('=I', data, offset + 36)[0]
+                if what == PROC_EVENT_FORK:
+                    pid, tgid = struct.unpack_from('=II', data, offset + 60)
+                    if pid == tgid:  # not a thread
+                        new.add(tgid)
+                elif what == PROC_EVENT_EXEC:
+                    new.add(struct.unpack_from('=II', data, offset + 52)[1])
+                elif what == PROC_EVENT_EXIT:
+                    pid, tgid = struct.unpack_from('=II', data, offset + 52)
+                    if pid == tgid:
+                        gone.add(tgid)
+                if not msglen:
+                    break
+                offset += (msglen + 3) & ~3
+
+
+def open_proc_connector(timeout=1):
+    """Return a ProcConnector, or None if it can't be used: the events
+    of a dummy child process must arrive within 'timeout' secs.
+    """
+    if not LINUX or not hasattr(socket, 'AF_NETLINK'):
+        return None
+    try:
+        conn = ProcConnector()
+    except (socket.error, OSError):
+        return None
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        select.select([conn], [], [], max(deadline - time.time(), 0))
+        try:
+            new, gone = conn.read()
+        except socket.error:
+            break
+        if pid in new or pid in gone:
+            return conn
+    conn.close()
+    return None
+
+
+def watch(filters, ladder, recursive=False, dryrun=False):
+    """Kill the processes passing 'filters' (or just print them if
+    'dryrun'), then keep a live process table and do the same for
+    every new process, forever. New processes are learnt from the
+    proc connector, else by diffing the pids in /proc every
+    WATCH_INTERVAL secs. In the latter case the new processes are
+    checked twice, on two consecutive passes, in case they were
+    caught between fork() and exec().
+    """
+    procs = snapshot()
+
+    def handle(pids):
+        found = select_procs(procs, filters, recursive=recursive,
+                             pids=pids)
+        if dryrun:
+            for p in found:
+                print(p.strrepr)
+        elif found:
+            for p in escalate(found, ladder):
+                logerr("%s survived even %s!" % (
+                    p.strrepr, stringify_sig(ladder[-1][0])))
+        return set(p.pid for p in found)
+
+    handle(None)
+    conn = open_proc_connector()
+    if VERBOSE:
+        print("watching via %s" % (
+            "proc connector" if conn is not None else "/proc polling"))
+    recheck = set()
+    while True:
+        if conn is not None:
+            select.select([conn], [], [])
+            try:
+                new, gone = conn.read()
+            except socket.error as err:
+                if err.errno != errno.ENOBUFS:
+                    raise
+                # events were lost; resync
+                pids = list_pids()
+                new, gone = pids - set(procs), set(procs) - pids
+        else:
+            time.sleep(WATCH_INTERVAL)
+            pids = list_pids()
+            fresh = pids - set(procs)
+            new, gone = fresh | (recheck & pids), set(procs) - pids
+        for pid in gone:
+            procs.pop(pid, None)
+        for pid in new:
+            info = read_info(pid)
+            if info is not None:
+                procs[pid] = info
+            else:
+                procs.pop(pid, None)
+        matched = handle(new)
+        if conn is None:
+            recheck = fresh - matched
 
-    def gone_callback(p):
-        print(hilite("%s is gone" % p.strrepr))
 
-    def wait_procs_and_exit(procs):
-        if not procs:
-            sys.exit(0)
-        gone, alive = psutil.wait_procs(
-            procs, timeout=timeout, callback=gone_callback)
-        if not alive:
-            sys.exit(0)
-        return alive
+def main():
+    global VERBOSE
 
     args = docopt(__doc__)
     name = args['<name>']
     dryrun = args['--dryrun']
-    timeout = args['--timeout'] or TIMEOUT
     recursive = args['--recursive']
     VERBOSE = args['--verbose']
+    try:
+        timeout = parse_duration(args['--timeout'] or str(TIMEOUT))
+        ladder = parse_signals(args['--signals'] or SIGNALS, timeout)
+        filters = make_filters(
+            name=name,
+            regex=args['--regex'],
+            user=args['--user'],
+            older=(parse_duration(args['--older'])
+                   if args['--older'] else None),
+            younger=(parse_duration(args['--younger'])
+                     if args['--younger'] else None),
+            min_rss=(parse_size(args['--min-rss'])
+                     if args['--min-rss'] else None),
+            min_cpu=(float(args['--min-cpu'])
+                     if args['--min-cpu'] else None),
+            port=int(args['--port']) if args['--port'] else None)
+    except (ValueError, re.error) as err:
+        sys.exit(str(err))
+    if not filters:
+        sys.exit("no criteria given: specify <name> and/or a filter")
+
+    if args['--watch']:
+        try:
+            watch(filters, ladder, recursive=recursive, dryrun=dryrun)
+        except KeyboardInterrupt:
+            pass
+        return
 
     # get procs matching criteria
-    procs = find_procs(name, recursive=recursive)
+    procs = find_procs(filters, recursive=recursive)
     if not procs:
         return
 
     # dry run
     if dryrun:
         for p in procs:
-            print(str_proc(p))
+            print(p.strrepr)
         return
 
-    # send SIGTERM
-    signaled = []
-    for p in procs:
-        signal_proc(p, signal.SIGTERM)
-    still_alive = wait_procs_and_exit(signaled)
-
-    # send SIGKILL
-    print()
-    signaled = []
-    for p in procs:
-        signal_proc(p, signal.SIGKILL)
-    still_alive = wait_procs_and_exit(signaled)
+    # send signals
+    still_alive = escalate(procs, ladder)
+    if not still_alive:
+        sys.exit(0)
 
     #
     print()
-    logerr("the following processes survived even SIGKILL!")
+    logerr("the following processes survived even %s!" %
+           stringify_sig(ladder[-1][0]))
     for p in still_alive:
         logerr(p.strrepr)
     sys.exit(1)
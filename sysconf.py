@@ -8,12 +8,19 @@ Import it as "from sysconf import something"
 
 import contextlib
 import errno
+import fnmatch
 import functools
+import hashlib
+import multiprocessing
 import os
+import pickle
+import re
 import shutil
 import subprocess
 import sys
+import stat
 import tempfile
+import types
 
 
 PYTHON = sys.executable
@@ -321,6 +328,316 @@ def cwd(path):
         os.chdir(cur_dir)
 
 
+def iter_blocks(f, chunk_size=1024 * 1024, head=b''):
+    """Read a file object opened in binary mode 'chunk_size' bytes at
+    a time and yield blocks made of whole lines: the partial line at
+    the end of a chunk is carried over to the next block (the last
+    block may lack the line feed). Memory usage is bounded by
+    'chunk_size' plus the longest line. 'head' is the data already
+    read from 'f', if any.
+    """
+    carry = []
+    chunk = head or f.read(chunk_size)
+    while chunk:
+        idx = chunk.rfind(b'\n')
+        if idx == -1:
+            carry.append(chunk)
+        else:
+            carry.append(chunk[:idx + 1])
+            yield b''.join(carry)
+            carry = [chunk[idx + 1:]]
+        chunk = f.read(chunk_size)
+    if carry and carry != [b'']:
+        yield b''.join(carry)
+
+
+# =============================================================================
+# --- tree walking
+# =============================================================================
+
+
+def _compile_ignore_rules(lines, base=''):
+    """Parse gitignore-style patterns into a list of
+    (base, match, anchored, dir_only, negate) tuples, where 'base' is
+    the directory (relative to the walked tree) they apply to.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip('\r\n').rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        # A slash at the beginning or in the middle anchors the
+        # pattern to the .gitignore directory.
+        anchored = '/' in line
+        line = line.lstrip('/')
+        if not line:
+            continue
+        match = re.compile(fnmatch.translate(line)).match
+        rules.append((base, match, anchored, dir_only, negate))
+    return rules
+
+
+def _read_gitignore(path, base):
+    try:
+        with open(path) as f:
+            return _compile_ignore_rules(f, base)
+    except (IOError, OSError, UnicodeDecodeError):
+        return []
+
+
+def _is_ignored(rules, relpath, name, is_dir):
+    ignored = False
+    for base, match, anchored, dir_only, negate in rules:
+        if dir_only and not is_dir:
+            continue
+        if anchored:
+            path = relpath[len(base) + 1:] if base else relpath
+            matched = match(path)
+        else:
+            matched = match(name)
+        if matched:
+            ignored = not negate
+    return ignored
+
+
+class _DirEntry(object):
+    """A minimal os.DirEntry stand-in based on os.lstat(), for Python
+    < 3.5 when the scandir module is not installed.
+    """
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._lstat = os.lstat(self.path)
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _scandir_fallback(path):
+    for name in os.listdir(path):
+        try:
+            yield _DirEntry(path, name)
+        except OSError:
+            pass
+
+
+@memoize
+def _get_scandir():
+    # imported lazily, so that importing this module on Python < 3.5
+    # doesn't require the scandir module
+    try:
+        from os import scandir
+    except ImportError:
+        try:
+            from scandir import scandir  # "pip install scandir"
+        except ImportError:
+            scandir = _scandir_fallback
+    return scandir
+
+
+def _listdir(path):
+    try:
+        return list(_get_scandir()(path))
+    except OSError:
+        return []
+
+
+def walk_files(top='.', ignore=(), gitignore=True, threads=1, ondir=None):
+    """Recursively walk 'top' and yield an os.DirEntry instance for
+    every regular file (or symlink to one), so that callers can reuse
+    the cached stat info.
+
+    Unlike os.walk() ignored directories are pruned *before*
+    descending into them. 'ignore' is a list of gitignore-style
+    patterns relative to 'top' (e.g. '/build/' only matches the
+    top-level build directory); if 'gitignore' is True the
+    .gitignore files found along the way are honoured as well.
+
+    With threads > 1 directories are listed ahead of time by a
+    thread pool (useful on network file systems), while entries are
+    still yielded in the same order as a serial walk.
+
+    If 'ondir' is given it's called with the path of every directory
+    which is descended into ('top' included), before listing it
+    (unless threads > 1).
+    """
+    executor = None
+    if threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=threads)
+
+    def submit(path):
+        if executor is None:
+            return path
+        return executor.submit(_listdir, path)
+
+    def result(item):
+        if executor is None:
+            return _listdir(item)
+        return item.result()
+
+    stack = [(top, '', _compile_ignore_rules(ignore), submit(top))]
+    try:
+        while stack:
+            path, relpath, rules, item = stack.pop()
+            if ondir is not None:
+                ondir(path)
+            entries = result(item)
+            if gitignore:
+                for entry in entries:
+                    if entry.name == '.gitignore':
+                        rules = rules + _read_gitignore(entry.path, relpath)
+                        break
+            subdirs = []
+            for entry in entries:
+                name = entry.name
+                rel = relpath + '/' + name if relpath else name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not is_dir and not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if rules and _is_ignored(rules, rel, name, is_dir):
+                    continue
+                if is_dir:
+                    subdirs.append((entry.path, rel, rules,
+                                    submit(entry.path)))
+                else:
+                    yield entry
+            stack.extend(reversed(subdirs))
+    finally:
+        if executor is not None:
+            for item in stack:
+                item[3].cancel()
+            # After a complete walk the threads are idle: wait for them
+            # to exit, so that the caller can safely fork.
+            executor.shutdown(wait=not stack)
+
+
+# =============================================================================
+# --- per-tree state files
+# =============================================================================
+
+
+def get_state_path(name, root='.', ext=''):
+    """Return the path of a file where the 'name' script keeps some
+    state about the 'root' tree: it lives in .git if there is one,
+    else in ~/.cache/<name>/.
+    """
+    if os.path.isdir(os.path.join(root, '.git')):
+        return os.path.join(root, '.git', name + ext)
+    path = os.path.abspath(root).encode('utf8')
+    return os.path.join(DIR_USER_HOME, '.cache', name,
+                        hashlib.md5(path).hexdigest() + ext)
+
+
+def load_state(path, version):
+    """Load a state file written by save_state(). Return None if it
+    doesn't exist, can't be read or has a different 'version'.
+    """
+    try:
+        with open(path, 'rb') as f:
+            file_version, state = pickle.load(f)
+    except (EnvironmentError, EOFError, ValueError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, TypeError):
+        # missing, truncated or written by something else: a cache miss
+        return None
+    return state if file_version == version else None
+
+
+def save_state(path, version, state):
+    """Atomically pickle 'state' into 'path', tagged with 'version'."""
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # A unique temp file, as concurrent runs may save at the same time.
+    fd, tmp = tempfile.mkstemp(dir=dirname or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((version, state), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# =============================================================================
+# --- parallel
+# =============================================================================
+
+
+_worker_fun = None
+
+
+def _init_worker(fun):
+    global _worker_fun
+    _worker_fun = fun
+
+
+def _call_worker(item):
+    result = _worker_fun(item)
+    if isinstance(result, types.GeneratorType):
+        result = list(result)
+    return item, result
+
+
+def parallel_map(fun, items, jobs=1, chunksize=1, min_items=0):
+    """Call fun(item) for every item and yield (item, result) tuples
+    in the same order. If jobs != 1 items are processed by a pool of
+    'jobs' processes (0 = number of CPUs): 'fun' must be picklable
+    and generators it returns are consumed into a list by the
+    workers. The pool is not started if 'items' is a sequence shorter
+    than 'min_items', as it's not worth paying the startup cost of
+    the worker processes.
+    The pool is started before 'items' is consumed, as it may be a
+    generator using threads (e.g. walk_files()) and forking while
+    they run is not safe.
+    """
+    if jobs == 1 or (hasattr(items, '__len__') and len(items) < min_items):
+        for item in items:
+            yield item, fun(item)
+        return
+    pool = multiprocessing.Pool(jobs or None, initializer=_init_worker,
+                                initargs=(fun, ))
+    try:
+        for ret in pool.imap(_call_worker, items, chunksize=chunksize):
+            yield ret
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
 # =============================================================================
 # --- network
 # =============================================================================